@@ -16,7 +16,7 @@ from validate_email import validate_email
 import assets
 import html
 import session
-from utils import email, mdb, get_logger, get_user_agent, load_settings, ymdhms, hms, days_hours_minutes, ymd, admin_session, thirty_days_ago, get_latest_change_log
+from utils import email, mdb, mdb_manager, get_logger, get_user_agent, load_settings, ymdhms, hms, days_hours_minutes, ymd, admin_session, thirty_days_ago, get_latest_change_log
 import world
 
 import sys
@@ -31,35 +31,166 @@ settings = load_settings()
 #   Maintenance and administrative functions
 #
 
+#   every index the application needs: (collection, keys, kwargs). Partial
+#   indexes can only use '$exists: True', so queries for survivors/settlements
+#   that are NOT removed/dead use the compound indexes and filter the rest.
+mdb_indexes = [
+    ("users", [("login", pymongo.ASCENDING)], {"unique": True}),
+    ("users", [("current_session", pymongo.ASCENDING)], {}),
+    ("users", [("latest_activity", pymongo.DESCENDING)], {}),
+    ("users", [("latest_sign_in", pymongo.DESCENDING)], {}),
+    ("users", [("recovery_code", pymongo.ASCENDING)], {"partialFilterExpression": {"recovery_code": {"$exists": True}}}),
+    ("sessions", [("login", pymongo.ASCENDING)], {}),
+    ("sessions", [("created_on", pymongo.ASCENDING)], {}),
+    ("sessions", [("expires_at", pymongo.ASCENDING)], {"expireAfterSeconds": 0}),   # TTL index: see get_session_expiration()
+    ("survivors", [("settlement", pymongo.ASCENDING), ("name", pymongo.ASCENDING)], {}),
+    ("survivors", [("settlement", pymongo.ASCENDING), ("created_on", pymongo.ASCENDING)], {}),
+    ("survivors", [("settlement", pymongo.ASCENDING)], {"name": "settlement_dead", "partialFilterExpression": {"dead": {"$exists": True}}}),
+    ("survivors", [("settlement", pymongo.ASCENDING), ("in_hunting_party", pymongo.ASCENDING)], {"partialFilterExpression": {"in_hunting_party": {"$exists": True}}}),
+    ("survivors", [("created_by", pymongo.ASCENDING)], {}),
+    ("survivors", [("name", pymongo.ASCENDING)], {}),
+    ("survivors", [("email", pymongo.ASCENDING)], {}),
+    ("settlements", [("created_by", pymongo.ASCENDING)], {}),
+    ("settlements", [("name", pymongo.ASCENDING)], {}),
+    ("settlements", [("created_on", pymongo.DESCENDING)], {}),
+    ("settlements", [("principles", pymongo.ASCENDING)], {}),
+    ("settlements", [("expansions", pymongo.ASCENDING)], {}),
+    ("settlements", [("hunt_started", pymongo.DESCENDING)], {"partialFilterExpression": {"current_quarry": {"$exists": True}}}),
+    ("settlement_events", [("settlement_id", pymongo.ASCENDING), ("created_on", pymongo.DESCENDING)], {}),
+    ("settlement_events", [("created_by", pymongo.ASCENDING)], {}),
+    ("the_dead", [("survivor_id", pymongo.ASCENDING)], {}),
+    ("the_dead", [("complete", pymongo.ASCENDING)], {"partialFilterExpression": {"complete": {"$exists": True}}}),
+    ("killboard", [("created_on", pymongo.DESCENDING)], {}),
+    ("world_history", [("created_on", pymongo.ASCENDING)], {}),
+    ("world_history", [("period", pymongo.ASCENDING), ("created_on", pymongo.ASCENDING)], {}),
+    ("user_admin", [("u_id", pymongo.ASCENDING), ("created_on", pymongo.DESCENDING)], {}),
+]
+
+
+def create_indexes():
+    """ Creates the indexes in 'mdb_indexes'. This is idempotent: indexes that
+    already exist are left alone, so it's safe to run on every deploy. """
+
+    for collection, keys, kwargs in mdb_indexes:
+        index_name = mdb[collection].create_index(keys, background=True, **kwargs)
+        logger.info("Ensured index '%s' on mdb.%s" % (index_name, collection))
+    return len(mdb_indexes)
+
+
+def get_canned_queries():
+    """ Returns a list of the application's hot queries as (description,
+    collection, query, sort) tuples, for use with audit_queries(). The _id's
+    are made up: we only care about the query plans. """
+
+    oid = ObjectId()
+    return [
+        ("session lookup by cookie", "users", {"current_session": oid}, None),
+        ("sessions by login", "sessions", {"login": "user@example.com"}, None),
+        ("expired sessions", "sessions", {"expires_at": {"$lt": datetime.utcnow()}}, None),
+        ("sessions without an expiration", "sessions", {"expires_at": {"$exists": False}}, None),
+        ("settlement survivors", "survivors", {"removed": {"$exists": False}, "settlement": oid, "_id": {"$nin": []}}, [("name", 1)]),
+        ("settlement survivors, chronological", "survivors", {"removed": {"$exists": False}, "settlement": oid}, [("created_on", 1)]),
+        ("settlement dead", "survivors", {"settlement": oid, "dead": {"$exists": True}}, None),
+        ("hunting party", "survivors", {"settlement": oid, "in_hunting_party": {"$exists": True}}, [("name", 1)]),
+        ("user survivors", "survivors", {"$or": [{"email": "user@example.com"}, {"created_by": oid}], "removed": {"$exists": False}}, [("name", 1)]),
+        ("user settlements", "settlements", {"created_by": oid}, None),
+        ("current hunt", "settlements", {"removed": {"$exists": False}, "name": {"$nin": ["Test", "Unknown"]}, "current_quarry": {"$exists": True}, "hunt_started": {"$gte": datetime.now() - timedelta(minutes=180)}}, [("hunt_started", -1)]),
+        ("settlement event log", "settlement_events", {"settlement_id": oid}, [("created_on", -1)]),
+        ("death record", "the_dead", {"survivor_id": oid}, None),
+        ("complete death records", "the_dead", {"complete": {"$exists": True}}, None),
+        ("latest kill", "killboard", {"settlement_name": {"$nin": ["Test", "Unknown"]}}, [("created_on", -1)]),
+        ("top survivor names", "survivors", {"name": {"$exists": True, "$nin": ["Anonymous", "Test", "Unknown"]}}, None),
+        ("top settlement names", "settlements", {"name": {"$exists": True, "$nin": ["Anonymous", "Test", "Unknown"]}}, None),
+        ("recent users", "users", {"latest_activity": {"$gte": datetime.now() - timedelta(hours=12)}}, [("latest_activity", -1)]),
+    ]
+
+
+def audit_queries():
+    """ Runs explain() on each of the canned queries and returns a list of
+    (description, collection, used_index) tuples. Logs a warning for every
+    query that does a collection scan. """
+
+    def find_stages(plan):
+        """ Returns all of the stage names in a (nested) winning plan. """
+        stages = [plan.get("stage")]
+        for child_key in ["inputStage", "inputStages"]:
+            child = plan.get(child_key)
+            if type(child) == dict:
+                stages.extend(find_stages(child))
+            elif type(child) == list:
+                for c in child:
+                    stages.extend(find_stages(c))
+        return stages
+
+    results = []
+    for description, collection, query, sort in get_canned_queries():
+        cursor = mdb[collection].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()
+        used_index = "COLLSCAN" not in find_stages(plan["queryPlanner"]["winningPlan"])
+        if not used_index:
+            logger.warn("Collection scan! mdb.%s query '%s': %s" % (collection, description, query))
+        results.append((description, collection, used_index))
+    return results
+
+
+
+def get_session_expiration(User, created_on):
+    """ Returns the datetime when a session that 'User' created on
+    'created_on' expires, or None if it never does. mdb.sessions has a TTL
+    index on 'expires_at', so mdb removes expired sessions on its own; a None
+    'expires_at' is ignored by the TTL index.
+
+    Admin sessions never expire; if the user wants to preserve their sessions,
+    they get thirty days; everybody else gets 24 hours.
+
+    Like the rest of the app, 'created_on' is naive local time, but pymongo
+    stores naive datetimes as UTC and the TTL monitor compares them to the
+    real UTC time, so 'expires_at' is naive UTC: compare it to utcnow(). """
+
+    if User.is_admin():
+        return None
+    created_on_utc = created_on + (datetime.utcnow() - datetime.now())
+    if User.get_preference("preserve_sessions"):
+        return created_on_utc + timedelta(days=30)
+    return created_on_utc + timedelta(days=1)
 
-def prune_sessions():
-    """ Removes sessions older than 24 hours. """
-    yesterday = datetime.now() - timedelta(days=1)
-    logger.debug("Searching for sessions older than %s to prune..." % yesterday)
-    old_sessions = mdb.sessions.find({"created_on": {"$lt": yesterday}}).sort("created_on")
-    logger.debug("%s sessions found." % old_sessions.count())
-
-    pruned_sessions = 0
-    preserved_sessions = 0
-    for s in old_sessions:
-        user = mdb.users.find_one({"login": s["login"]})
-        U = assets.User(user["_id"], session_object=admin_session)
-        if U.is_admin():
-#            logger.debug("Preserving session for admin user '%s'" % user["login"])
-            preserved_sessions += 1
-        elif U.get_preference("preserve_sessions") and s["created_on"] > thirty_days_ago:   # if it's older than 30 days, ignore the preference
-#            logger.debug("Preserving session for user '%s' because of user preference." % user["login"])
-            preserved_sessions += 1
-        else:
-            s_id = s["_id"]
-            logger.debug("Pruning old session '%s' (%s)" % (s_id, s["login"]))
-            remove_session(s_id, "admin")
-            pruned_sessions += 1
 
-    if pruned_sessions > 0:
-        logger.info("Pruned %s old sessions." % pruned_sessions)
-    if preserved_sessions > 0:
-        logger.info("Preserved %s sessions due to user preference." % preserved_sessions)
+def prune_sessions():
+    """ The TTL index on 'expires_at' does most of our pruning. This is the
+    sweeper for everything it doesn't do:
+
+        - sessions without an 'expires_at' (e.g. sessions created before we had
+            one) get one, using get_session_expiration();
+        - sessions whose user no longer exists get removed;
+        - expired sessions get removed right away (mdb's TTL monitor only runs
+            once a minute) and their users lose their 'current_session'.
+
+    Returns the number of sessions that were removed. """
+
+    now = datetime.utcnow()     # see get_session_expiration()
+
+    unexpiring_sessions = list(mdb.sessions.find({"expires_at": {"$exists": False}}, {"login": True, "created_on": True}))
+    if unexpiring_sessions != []:
+        logins = list(set([s["login"] for s in unexpiring_sessions]))
+        users = dict([(u["login"], u) for u in mdb.users.find({"login": {"$in": logins}})])
+        for s in unexpiring_sessions:
+            if s["login"] not in users.keys():
+                remove_session(s["_id"], "admin")
+                continue
+            U = assets.User(users[s["login"]]["_id"], session_object=admin_session, user_document=users[s["login"]])
+            expires_at = get_session_expiration(U, s["created_on"])
+            mdb.sessions.update_one({"_id": s["_id"]}, {"$set": {"expires_at": expires_at}})
+        logger.info("Set 'expires_at' on %s sessions." % len(unexpiring_sessions))
+
+    expired_sessions = [s["_id"] for s in mdb.sessions.find({"expires_at": {"$lt": now}}, {"_id": True})]
+    if expired_sessions != []:
+        mdb.sessions.delete_many({"_id": {"$in": expired_sessions}})
+        mdb.users.update_many({"current_session": {"$in": expired_sessions}}, {"$unset": {"current_session": True}})
+        logger.info("Pruned %s expired sessions." % len(expired_sessions))
+
+    return len(expired_sessions)
 
 #
 #   administrative helper functions for user-land
@@ -129,7 +260,6 @@ def authenticate(login, password):
         user["latest_sign_in"] = datetime.now()
         mdb.users.save(user)
         logger.debug("User '%s' authenticated successfully (%s)." % (login, get_user_agent()))
-        prune_sessions()
         return True
     else:
         logger.debug("User '%s' FAILED to authenticate successfully." % login)
@@ -142,6 +272,7 @@ def remove_session(session_id, login):
 
     s = ObjectId(session_id)
     mdb.sessions.remove({"_id": s})
+    mdb.users.update_one({"current_session": s}, {"$unset": {"current_session": True}})
     logger.debug("User '%s' removed session '%s' successfully." % (login, session_id))
 
 
@@ -233,7 +364,7 @@ def update_survivor(operation, s_id=None, attrib=False, attrib_value=False, surv
             manual_approve = raw_input("\n    Remove '%s' from %s?\n\tType YES to proceed: " % (attrib_value, survivor[attrib]))
             if manual_approve == "YES":
                 survivor[attrib].remove(attrib_value)
-                mdb.survivors.save(survivor)
+                mdb.survivors.update_one({"_id": survivor["_id"]}, {"$set": {attrib: survivor[attrib]}, "$inc": {"doc_version": 1}})
             else:
                 print("    Aborting...\n")
                 return False
@@ -248,7 +379,12 @@ def update_survivor(operation, s_id=None, attrib=False, attrib_value=False, surv
         else:
             del(survivor[survivor_key])
             print("Key '%s' deleted!\n" % survivor_key)
-            mdb.survivors.save(survivor)
+            mdb.survivors.update_one({"_id": survivor["_id"]}, {"$unset": {survivor_key: ""}, "$inc": {"doc_version": 1}})
+
+    # we don't check the settlement's minimums here (e.g. if we just deleted
+    #   'dead'), so make the settlement get normalized the next time it loads
+    if operation in ["remove", "del"]:
+        mdb.settlements.update_one({"_id": survivor["settlement"]}, {"$unset": {"schema_version": ""}, "$inc": {"doc_version": 1}})
 
 
     print("\n  Survivor updated successfully!\n")
@@ -292,11 +428,11 @@ def pretty_view_user(u_id):
         if type == "survivor":
             return " %s - %s [%s] %s" % (a["_id"], a["name"], a["sex"], a["email"])
 
-    if User.settlements == []:
+    if User.get_settlements() == []:
         print(" No settlements.\n")
     else:
-        print("\t%s settlements:\n" % len(User.settlements))
-        for settlement in User.settlements:
+        print("\t%s settlements:\n" % len(User.get_settlements()))
+        for settlement in User.get_settlements():
             print asset_repr(settlement, "settlement")
             settlement_survivors = mdb.survivors.find({"settlement": settlement["_id"]})
             if settlement_survivors.count() > 0:
@@ -455,17 +591,61 @@ class Panel:
         recent_cut_off = datetime.now() - timedelta(hours=hours_ago)
         return mdb.users.find({"latest_activity": {"$gte": recent_cut_off}, "login": {"$ne": self.admin_login}}).sort("latest_activity", -1)
 
+    def render_pool_stats(self):
+        """ Renders the MongoDB connection pool stats for the process that is
+        serving the panel as an html table. """
+
+        output = html.panel.panel_table_top
+        output += html.panel.panel_table_header.safe_substitute(title="MongoDB Connection Pool")
+        zebra = ""
+        pool_stats = mdb_manager.get_stats()
+        for k in sorted(pool_stats.keys()):
+            output += html.panel.panel_table_row.safe_substitute(zebra=zebra, key=k, value=pool_stats[k])
+            if zebra == "":
+                zebra = "zebra_True"
+            else:
+                zebra = ""
+        output += html.panel.panel_table_bot
+        return output
+
+    def render_history(self, days=14, keys=["total_users_last_30", "recent_sessions", "live_survivors", "avg_ly"]):
+        """ Renders the last 'days' days of world history for 'keys' as an
+        html table: one row per day. """
+
+        output = html.panel.panel_table_top
+        output += html.panel.panel_table_header.safe_substitute(title="World History")
+        zebra = ""
+        for snapshot in world.get_history(datetime.now() - timedelta(days=days), keys=keys, daily=True):
+            values = ", ".join(["%s: %s" % (k, snapshot.get(k, None)) for k in keys])
+            output += html.panel.panel_table_row.safe_substitute(zebra=zebra, key=snapshot["created_on"].strftime(ymd), value=values)
+            if zebra == "":
+                zebra = "zebra_True"
+            else:
+                zebra = ""
+        output += html.panel.panel_table_bot
+        return output
+
+    def get_request_log_name(self):
+        """ In 'application' mode, requests are handled in-process by server.py
+        and get logged to server.log; in 'cgi' mode, each request is an index
+        process and gets logged to index.log. """
+        if settings.get("server", "mode") == "application":
+            return "server.log"
+        return "index.log"
+
     def get_last_n_log_lines(self, lines):
-        log_path = os.path.join(settings.get("application", "log_dir"), "index.log")
-        index_log = file(log_path, "r")
-        return index_log.readlines()[-lines:]
+        log_path = os.path.join(settings.get("application", "log_dir"), self.get_request_log_name())
+        if not os.path.isfile(log_path):
+            return []
+        request_log = file(log_path, "r")
+        return request_log.readlines()[-lines:]
 
     def render_html(self):
         """ Renders the whole panel. """
 
         output = html.panel.headline.safe_substitute(
-            defeated_monsters = world.kill_board("html_table_rows", admin=True),
-            warehouse_table = self.warehouse.render("html_table"),
+            defeated_monsters = world.kill_board("html_table_rows", admin=True, kill_counts=world.get_counters()["kills"]),
+            warehouse_table = self.warehouse.render("html_table") + self.render_pool_stats() + self.render_history(),
             recent_users_count = self.recent_users.count(),
             users = self.warehouse.get("total_users"),
             sessions = mdb.sessions.find().count(),
@@ -480,13 +660,21 @@ class Panel:
         )
 
 
-        for user in self.recent_users:
+        # get settlements and survivor counts for all of the recent users at
+        #   once, rather than querying for them user by user
+        recent_users = list(self.recent_users)
+        recent_user_ids = [u["_id"] for u in recent_users]
+        asset_counts = world.get_user_asset_counts(recent_user_ids)
+        user_settlements = {}
+        for s in mdb.settlements.find({"created_by": {"$in": recent_user_ids}}, {"_id": True, "created_by": True}).sort("name"):
+            user_settlements.setdefault(s["created_by"], []).append(s)
+
+        for user in recent_users:
             User = assets.User(user_id=user["_id"], session_object=self.Session)
 
             # create settlement summaries
-            settlements = mdb.settlements.find({"created_by": User.user["_id"]}).sort("name")
             settlement_strings = []
-            for s in settlements:
+            for s in user_settlements.get(User.user["_id"], []):
                 S = assets.Settlement(settlement_id=s["_id"], session_object=self.Session)
                 settlement_strings.append(S.render_admin_panel_html())
 
@@ -501,12 +689,12 @@ class Panel:
                 latest_activity_mins = (datetime.now() - User.user["latest_activity"]).seconds // 60,
                 latest_action = User.user["latest_action"],
                 settlements = "<br/>".join(settlement_strings),
-                survivor_count = mdb.survivors.find({"created_by": User.user["_id"]}).count(),
+                survivor_count = asset_counts[User.user["_id"]]["survivors"],
                 user_created_on = User.user["created_on"].strftime(ymd),
                 user_created_on_days = (datetime.now() - User.user["created_on"]).days
             )
 
-        output += "<hr/><h1>index.log</h1>"
+        output += "<hr/><h1>%s</h1>" % self.get_request_log_name()
 
         log_lines = self.get_last_n_log_lines(50)
         zebra = False
@@ -518,9 +706,58 @@ class Panel:
                 output += html.panel.log_line.safe_substitute(line=l)
                 zebra = "grey"
 
+        self.Session.event_buffer.flush()
         return output
 
 
+def migrate_documents():
+    """ Batch-upgrades every settlement and survivor document with an old (or no)
+    'schema_version' to the current data model. This is the same migration that
+    happens when one of those documents is loaded, so it's safe to run while the
+    app is up. Settlements are loaded as their creator, since normalization
+    checks user preferences. """
+
+    def outdated(current_version):
+        return {"$or": [{"schema_version": {"$exists": False}}, {"schema_version": {"$lt": current_version}}]}
+
+    migrated = {"settlements": 0, "survivors": 0}
+    start = datetime.now()
+
+    settlement_ids = set()
+    for s in mdb.settlements.find(outdated(assets.settlement_schema_version), {"_id": True}):
+        settlement_ids.add(s["_id"])
+    for s in mdb.survivors.find(outdated(assets.survivor_schema_version), {"settlement": True}):
+        settlement_ids.add(s["settlement"])
+
+    for settlement_id in settlement_ids:
+        settlement = mdb.settlements.find_one({"_id": settlement_id}, {"created_by": True})
+        if settlement is None:
+            logger.warn("Survivors of settlement %s cannot be migrated: settlement not found!" % settlement_id)
+            continue
+        if mdb.users.find_one({"_id": settlement["created_by"]}, {"_id": True}) is None:
+            logger.warn("Settlement %s cannot be migrated: creator %s not found!" % (settlement_id, settlement["created_by"]))
+            continue
+
+        # one Session per settlement, so the identity map doesn't grow forever
+        S = session.Session()
+        S.User = assets.User(user_id=settlement["created_by"], session_object=S)
+        S.Settlement = assets.Settlement(settlement_id=settlement_id, session_object=S, update_mins=False)
+        if S.Settlement.needs_migration():
+            S.Settlement.update_mins()
+            migrated["settlements"] += 1
+
+        survivor_query = outdated(assets.survivor_schema_version)
+        survivor_query["settlement"] = settlement_id
+        for survivor in mdb.survivors.find(survivor_query, {"_id": True}):
+            if not S.identity_map.is_normalized("survivors", survivor["_id"]):
+                assets.Survivor(survivor_id=survivor["_id"], session_object=S)
+                migrated["survivors"] += 1
+        S.event_buffer.flush()
+
+    logger.info("Migrated %s settlements and %s survivors in %s." % (migrated["settlements"], migrated["survivors"], datetime.now() - start))
+    return migrated
+
+
 def valkyrie():
     """ Checks all extant survivors and adds them to mdb.the_dead if they've got
     the 'dead' attrib. Tries to get their 'cause_of_death'. """
@@ -667,6 +904,10 @@ if __name__ == "__main__":
 
     parser.add_option("--play_summary", dest="play_summary", help="Summarize play sessions for users.", action="store_true", default=False)
     parser.add_option("--valkyrie", dest="valkyrie", help="Run the valkyrie.", action="store_true", default=False)
+    parser.add_option("--prune_sessions", dest="prune_sessions", help="Run the session sweeper (the TTL index does most of this).", action="store_true", default=False)
+    parser.add_option("--indexes", dest="indexes", help="Create all of the application's mdb indexes.", action="store_true", default=False)
+    parser.add_option("--explain", dest="explain", help="Run explain() on the application's queries and flag collection scans.", action="store_true", default=False)
+    parser.add_option("--migrate", dest="migrate", help="Migrate all settlements and survivors to the current data model.", action="store_true", default=False)
 
     parser.add_option("-u", dest="user_id", help="Specify a user to work with.", default=False)
     parser.add_option("-p", dest="user_pass", help="Update a user's password (requires -u).", default=False)
@@ -697,6 +938,23 @@ if __name__ == "__main__":
     if options.valkyrie:
         valkyrie()
 
+    if options.prune_sessions:
+        print(" Pruned %s sessions." % prune_sessions())
+
+    if options.indexes:
+        print(" Ensured %s indexes." % create_indexes())
+
+    if options.explain:
+        for description, collection, used_index in audit_queries():
+            if used_index:
+                print(" OK        mdb.%s: %s" % (collection, description))
+            else:
+                print(" COLLSCAN  mdb.%s: %s" % (collection, description))
+
+    if options.migrate:
+        migrated = migrate_documents()
+        print(" Migrated %s settlements and %s survivors." % (migrated["settlements"], migrated["survivors"]))
+
     if options.user_repr:
         User = assets.User(user_id=options.user_repr, session_object=admin_session)
         print User.dump_assets()
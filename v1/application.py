@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+#   standard
+from datetime import datetime, timedelta
+import imp
+import mimetypes
+import os
+import sys
+import threading
+import traceback
+
+#   custom
+import utils
+from utils import get_logger, load_settings
+
+#   importing these here means that the game catalog, the models and the html
+#   templates are loaded once per process instead of once per request
+import admin
+import assets
+import game_assets
+import html
+import models
+import session
+import world
+
+settings = load_settings()
+logger = get_logger()
+
+#   fail at startup, rather than on the first request that needs $convert
+utils.mdb_manager.check_server_version()
+
+app_root = os.path.dirname(os.path.abspath(__file__))
+
+#   these are the CGI scripts that we run in-process; the URL path is the key
+entry_point_scripts = {
+    "/": "index",
+    "/index": "index",
+    "/get_image": "get_image",
+    "/get_user": "get_user",
+}
+
+#   never serve these as static content
+forbidden_extensions = [".py", ".pyc", ".cfg", ".log", ".pickle", ".npy"]
+
+#   the entry point scripts (and the code they call) read os.environ, sys.stdin
+#   and sys.stdout, which are process-global, so requests have to take turns:
+#   each process handles ONE request at a time, no matter how many request
+#   threads the server has. Concurrency comes from the server's 'workers'
+request_lock = threading.Lock()
+
+
+class OutputBuffer(object):
+    """ File-like object that stands in for sys.stdout while an entry point is
+    running: collects everything the script prints so that we can turn it into
+    a response. """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        self.chunks.append(s)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+def load_entry_point(script_name):
+    """ Compiles one of the CGI scripts in the application root (they don't have
+    a .py extension, so we can't just import them) and returns it as a module.
+    This happens once per process. """
+
+    script_path = os.path.join(app_root, script_name)
+    module = imp.new_module(script_name)
+    module.__file__ = script_path
+    code = compile(file(script_path, "rb").read(), script_path, "exec")
+    exec code in module.__dict__
+    return module
+
+
+entry_points = {}
+for script_name in set(entry_point_scripts.values()):
+    entry_points[script_name] = load_entry_point(script_name)
+
+
+def refresh_request_globals():
+    """ A couple of the helpers in utils.py are computed at import time, which
+    is fine for a CGI process that only lives for one request. When we stay
+    resident, we have to bring them up to date before each request. """
+
+    horizons = {
+        "thirty_days_ago": datetime.now() - timedelta(days=30),
+        "recent_session_cutoff": datetime.now() - timedelta(hours=12),
+    }
+    for module in [utils, admin, assets, world]:
+        for k, v in horizons.iteritems():
+            if hasattr(module, k):
+                setattr(module, k, v)
+
+
+def split_cgi_output(output):
+    """ Splits the raw output of a CGI script into a status, a list of header
+    tuples and a body. Scripts in this app terminate their headers with "\\n",
+    "\\r\\n" or a mix of both, so we're lenient about line endings. """
+
+    status = "200 OK"
+    headers = []
+    pos = 0
+    while True:
+        end = output.find("\n", pos)
+        if end == -1:
+            return status, [("Content-type", "text/html")], output
+        line = output[pos:end].rstrip("\r")
+        pos = end + 1
+        if line == "":
+            break
+        if ":" not in line:
+            return status, [("Content-type", "text/html")], output
+        h_key, h_value = line.split(":", 1)
+        h_key = h_key.strip()
+        h_value = h_value.strip()
+        if h_key.lower() == "status":
+            status = h_value
+        else:
+            headers.append((h_key, h_value))
+
+    return status, headers, output[pos:]
+
+
+def run_entry_point(script_name, environ):
+    """ Runs an entry point's main() function with a CGI-style environment and
+    returns whatever it printed. html.render() and friends finish requests by
+    calling sys.exit(), so SystemExit is the normal way out of here. """
+
+    output_buffer = OutputBuffer()
+
+    with request_lock:
+        saved_environ = dict(os.environ)
+        saved_stdin, saved_stdout = sys.stdin, sys.stdout
+        try:
+            for k, v in environ.iteritems():
+                if type(v) == str:
+                    os.environ[k] = v
+            sys.stdin = environ["wsgi.input"]
+            sys.stdout = output_buffer
+            refresh_request_globals()
+            try:
+                entry_points[script_name].main()
+            except SystemExit:
+                pass
+        finally:
+            sys.stdin, sys.stdout = saved_stdin, saved_stdout
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+    return output_buffer.getvalue()
+
+
+def serve_static(path, start_response):
+    """ Serves a file from the application root, the way the CGI server's
+    SimpleHTTPRequestHandler used to. Application code and config files are
+    off-limits. """
+
+    file_path = os.path.normpath(os.path.join(app_root, path.lstrip("/")))
+    file_name = os.path.basename(file_path)
+    if not file_path.startswith(app_root + os.sep) or file_name.startswith(".") or os.path.splitext(file_path)[1] in forbidden_extensions or file_name in entry_point_scripts.values() or not os.path.isfile(file_path):
+        start_response("404 Not Found", [("Content-type", "text/html")])
+        return ["File Not Found!"]
+
+    content_type = mimetypes.guess_type(file_path)[0]
+    if content_type is None:
+        content_type = "application/octet-stream"
+    payload = file(file_path, "rb").read()
+    start_response("200 OK", [("Content-type", content_type), ("Content-Length", str(len(payload)))])
+    return [payload]
+
+
+def application(environ, start_response):
+    """ WSGI callable. Runs the index, get_image and get_user entry points
+    in-process against the already-imported application modules and serves
+    everything else as static content. """
+
+    path = environ.get("PATH_INFO", "/")
+    if path not in entry_point_scripts.keys():
+        return serve_static(path, start_response)
+
+    try:
+        output = run_entry_point(entry_point_scripts[path], environ)
+    except Exception as e:
+        logger.error("Caught exception while running '%s' in-process!" % path)
+        logger.exception(e)
+        start_response("500 Internal Server Error", [("Content-type", "text/html")], sys.exc_info())
+        return [html.meta.error_500.safe_substitute(msg="Could not render '%s'!" % path, exception=traceback.format_exc().replace("\n", "<br/>")).split("\n\n", 1)[1]]
+
+    status, headers, body = split_cgi_output(output)
+    start_response(status, headers)
+    return [body]
@@ -3,7 +3,7 @@
 from bson.objectid import ObjectId
 from bson import json_util
 from copy import copy
-from collections import defaultdict
+from collections import defaultdict, deque
 from cStringIO import StringIO
 from datetime import datetime, timedelta
 import gridfs
@@ -30,23 +30,46 @@ import world
 
 settings = load_settings()
 
+#   bump these when the survivor or settlement data model changes. Documents
+#   with an older 'schema_version' are migrated when they're loaded, or all at
+#   once, offline, with 'admin.py --migrate'
+survivor_schema_version = 1
+settlement_schema_version = 1
+
+#   the keys that User.get_settlements() and User.get_survivors() load
+settlement_projection = {"name": True, "created_by": True, "created_on": True, "lantern_year": True, "population": True, "death_count": True, "abandoned": True}
+survivor_projection = {"name": True, "sex": True, "email": True, "created_by": True, "settlement": True, "dead": True, "retired": True, "hunt_xp": True, "Insanity": True, "returning_survivor": True, "abilities_and_impairments": True}
+
 class User:
 
-    def __init__(self, user_id, session_object=None):
+    def __init__(self, user_id, session_object=None, user_document=None):
         """ Initialize with a user's _id to create an object with his complete
         user object and all settlements. Like all asset classes, you cannot
-        initialize this one without a valid session object. """
+        initialize this one without a valid session object.
+
+        If you've already got the user's document, pass it in as the
+        'user_document' kwarg to save a trip to mdb. """
 
         self.logger = get_logger()
         user_id = ObjectId(user_id)
-        self.user = mdb.users.find_one({"_id": user_id})
+        if user_document is not None and user_document["_id"] == user_id:
+            self.user = user_document
+        else:
+            self.user = mdb.users.find_one({"_id": user_id})
 
         self.Session = session_object
         if self.Session is None:
             raise Exception("User Objects may not be initialized without a session object!")
 
-        self.get_settlements()
-        self.get_survivors()
+        # these get loaded the first time somebody asks for them: see
+        #   get_settlements() and get_survivors()
+        self.settlements = None
+        self.survivors = None
+        self.dashboard = None
+
+        # activity that mark_usage() hasn't written yet: see flush_usage()
+        self.usage_log = []
+        self.usage = {}
 
         self.preference_keys = [t[0] for t in settings.items("users")]
 
@@ -132,11 +155,18 @@ class User:
                 elif p_value == "False":
                     self.user["preferences"][p] = False
                 user_admin_log_dict["msg"] += "'%s' -> %s; " % (p, p_value)
+        mdb.users.update_one({"_id": self.user["_id"]}, {"$set": {"preferences": self.user["preferences"]}})
 
         user_admin_log_dict["msg"] = user_admin_log_dict["msg"].strip()
         mdb.user_admin.insert(user_admin_log_dict)
         self.logger.debug("%s updated preferences." % self.user["login"])
 
+        # the current session's expiration depends on 'preserve_sessions'
+        if "preserve_sessions" in params and "current_session" in self.user.keys():
+            s = mdb.sessions.find_one({"_id": self.user["current_session"]}, {"created_on": True})
+            if s is not None:
+                mdb.sessions.update_one({"_id": s["_id"]}, {"$set": {"expires_at": admin.get_session_expiration(self, s["created_on"])}})
+
 
     def dump_assets(self, dump_type=None):
         """ Returns a dictionary representation of a user's complete assets. Due
@@ -147,6 +177,9 @@ class User:
 
         self.logger.debug("Beginning '%s' dump for %s" % (dump_type, self))
 
+        if getattr(self.Session, "event_buffer", None) is not None:
+            self.Session.event_buffer.flush()
+
         assets_dict = {
             "user": self.user,
             "settlements": list(mdb.settlements.find({"created_by": self.user["_id"]})),
@@ -196,17 +229,35 @@ class User:
         return assets_dict
 
 
+    def forget_assets(self):
+        """ Call this after creating or removing a settlement or survivor, so
+        that get_settlements() and get_survivors() go back to mdb. """
+        self.settlements = None
+        self.survivors = None
+        self.dashboard = None
+
+
+    def get_dashboard(self):
+        """ Returns the user's dashboardModel, which gets built (once) the
+        first time somebody asks for it. """
+        if self.dashboard is None:
+            self.dashboard = dashboardModel(self)
+        return self.dashboard
+
+
     def get_settlements(self, return_as=False):
         """ Returns the user's settlements in a number of ways. Leave
-        'return_as' unspecified if you want a mongo cursor back. """
+        'return_as' unspecified if you want a list back.
 
-        self.settlements = list(mdb.settlements.find({
-            "created_by": self.user["_id"],
-            "removed": {"$exists": False},
-            }).sort("name"))
+        The list is loaded once (and then remembered) and its dicts only have
+        the keys in 'settlement_projection': initialize a Settlement if you
+        need the whole thing. """
 
         if self.settlements is None:
-            return "NONE!"
+            self.settlements = list(mdb.settlements.find({
+                "created_by": self.user["_id"],
+                "removed": {"$exists": False},
+                }, settlement_projection).sort("name"))
 
         if return_as == "html_option":
             output = ""
@@ -215,70 +266,39 @@ class User:
             return output
 
         if return_as == "asset_links":
-            output = ""
-            for settlement in self.settlements:
-                S = Settlement(settlement_id=settlement["_id"], session_object=self.Session)
-                output += S.asset_link()
-            return output
+            return self.get_dashboard().settlement_links()
 
         return self.settlements
 
 
     def get_survivors(self, return_type=False):
         """ Returns all of the survivors that a user can access. Leave
-        the 'return_type' kwarg unspecified/False if you want a mongo cursor
-        back (instead of fruity HTML crap). """
+        the 'return_type' kwarg unspecified/False if you want a list back
+        (instead of fruity HTML crap).
 
-        survivors = list(mdb.survivors.find({"$or": [
-            {"email": self.user["login"]},
-            {"created_by": self.user["_id"]},
-            ], "removed": {"$exists": False}}
-        ).sort("name"))
+        Like get_settlements(), the list is loaded once and its dicts only
+        have the keys in 'survivor_projection'. """
+
+        if self.survivors is None:
+            self.survivors = list(mdb.survivors.find({"$or": [
+                {"email": self.user["login"]},
+                {"created_by": self.user["_id"]},
+                ], "removed": {"$exists": False}},
+                survivor_projection,
+            ).sort("name"))
+        survivors = self.survivors
 
         # user version
 
         if return_type == "asset_links":
-            output = ""
-            for s in survivors:
-                S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-                output += S.asset_link()
-            return output
+            return self.get_dashboard().survivor_links()
 
         return survivors
 
 
     def get_campaigns(self):
         """ This function gets all campaigns in which the user is involved. """
-
-        self.get_settlements()
-        game_list = set()
-
-        if self.settlements is not None:
-            for s in self.settlements:
-                if s is not None:
-                    game_list.add(s["_id"])
-
-        for s in self.get_survivors():
-            game_list.add(s["settlement"])
-
-        output = ""
-
-        game_dict = {}
-        for settlement_id in game_list:
-            S = Settlement(settlement_id=settlement_id, session_object=self.Session)
-            if S.settlement is not None:
-                if not "abandoned" in S.settlement.keys():
-                    game_dict[settlement_id] = S.settlement["name"]
-            else:
-                self.logger.error("Could not find settlement %s while loading campaigns for %s" % (settlement_id, self.get_name_and_id()))
-        sorted_game_tuples = sorted(game_dict.items(), key=operator.itemgetter(1))
-
-        for settlement_tuple in sorted_game_tuples:
-            settlement_id = settlement_tuple[0]
-            S = Settlement(settlement_id=settlement_id, session_object=self.Session)
-            if S.settlement is not None:
-                output += S.asset_link(context="dashboard_campaign_list")
-        return output
+        return self.get_dashboard().campaign_links()
 
 
     def get_last_n_user_admin_logs(self, logs):
@@ -289,22 +309,57 @@ class User:
 
 
     def mark_usage(self, action=None):
-        """ Updates the user's mdb object with some data. """
-        if not "activity_log" in self.user.keys():
-            self.user["activity_log"] = []
+        """ Records some activity for the user. If the user belongs to a real
+        Session, the activity gets buffered until the end of the request, so
+        that every call made during a request becomes one write: see
+        flush_usage(). Otherwise (e.g. the admin_session), it gets written
+        right away. """
 
-        self.user["activity_log"].append((datetime.now(), action))
-        self.user["activity_log"] = self.user["activity_log"][-10:] # only save the last 10
+        now = datetime.now()
+        self.usage_log.append((now, action))
+        self.usage["latest_action"] = action
+        self.usage["latest_activity"] = now
+        self.user.update(self.usage)
+
+        if getattr(self.Session, "event_buffer", None) is None:
+            self.flush_usage()
 
-        self.user["latest_action"] = action
-        self.user["latest_activity"] = datetime.now()
-        self.user["latest_user_agent"] = str(get_user_agent())
-        mdb.users.save(self.user)
 
     def mark_auth(self, auth_dt=None):
+        self.usage["latest_succesful_authentication"] = auth_dt
         self.mark_usage("successful sign-in")
-        self.user["latest_succesful_authentication"] = auth_dt
-        mdb.users.save(self.user)
+
+
+    def get_user_agent_repr(self):
+        """ Returns the user agent as a string. Sessions parse it once, when
+        they're created, so use the session's if we've got one. """
+
+        s = getattr(self.Session, "session", None)
+        if s is not None and "repr" in s.get("user_agent", {}).keys():
+            return s["user_agent"]["repr"]
+        return str(get_user_agent())
+
+
+    def flush_usage(self):
+        """ Writes the activity recorded by mark_usage() with one atomic
+        update: the activity log gets $push'd (and trimmed to the last 10
+        entries) and the 'latest_*' attribs get $set, so we never rewrite the
+        whole user document. Returns False if there was nothing to write. """
+
+        if self.usage_log == []:
+            return False
+
+        self.usage["latest_user_agent"] = self.get_user_agent_repr()
+        self.user["latest_user_agent"] = self.usage["latest_user_agent"]
+        usage_log, usage = self.usage_log, self.usage
+        self.usage_log = []
+        self.usage = {}
+
+        mdb.users.update_one({"_id": self.user["_id"]}, {
+            "$push": {"activity_log": {"$each": usage_log, "$slice": -10}},    # only keep the last 10
+            "$set": usage,
+        })
+        return True
 
 
 
@@ -407,6 +462,194 @@ class User:
 
 
 
+#
+#   ASSET LINKS AND THE DASHBOARD
+#
+
+def render_survivor_link(survivor, settlement, view="survivor", button_class="survivor", link_text=False, include=["hunt_xp", "insanity", "sex", "dead", "retired", "returning"], disabled=False):
+    """ Renders an asset link for a survivor dict. 'settlement' is the
+    survivor's settlement dict: it only needs its name and lantern_year, and it
+    can be None if we haven't got it (in which case, we skip the attribs that
+    need it). Survivor.asset_link() and the dashboardModel both use this. """
+
+    if not link_text:
+        link_text = "<b>%s</b>" % survivor["name"]
+        if "sex" in include:
+            link_text += " [%s]" % get_functional_sex(survivor, "html")
+
+    if disabled:
+        link_text += "<br />%s" % survivor["email"]
+
+    if include != []:
+        attribs = []
+        if "dead" in include:
+            if "dead" in survivor.keys():
+                button_class = "grey"
+                attribs.append("Dead")
+
+        if "retired" in include:
+            if "retired" in survivor.keys():
+                button_class = "warn"
+                attribs.append("Retired")
+
+        if "returning" in include and settlement is not None:
+            if int(settlement["lantern_year"]) in survivor.get("returning_survivor", []):
+                attribs.append("Returning Survivor")
+
+        if "settlement_name" in include and settlement is not None:
+            attribs.append(settlement["name"])
+
+        if "hunt_xp" in include:
+            attribs.append("XP: %s" % survivor.get("hunt_xp", 0))
+
+        if "insanity" in include:
+            attribs.append("Insanity: %s" % survivor.get("Insanity", 0))
+
+        if attribs != []:
+            suffix = "<br /> "
+            suffix += ", ".join(attribs)
+            suffix += ""
+            link_text += suffix
+
+    if disabled:
+        disabled = "disabled"
+        button_class= "unclickable"
+
+    return html.dashboard.view_asset_button.safe_substitute(
+        button_class = button_class,
+        asset_type = view,
+        asset_id = survivor["_id"],
+        asset_name = link_text,
+        disabled = disabled,
+        desktop_text = "",
+    )
+
+
+def render_settlement_link(settlement, context=None, player_count=0):
+    """ Renders an asset link for a settlement dict. See the docs for
+    Settlement.asset_link() for the contexts. 'player_count' is only used by
+    the 'dashboard_campaign_list' context. """
+
+    if context == "campaign_summary":
+        button_class = "yellow floating_asset_button"
+        link_text = html.dashboard.settlement_flash
+        desktop_text = "Edit %s" % settlement["name"]
+        asset_type = "settlement"
+    elif context == "asset_management":
+        button_class = "gradient_purple floating_asset_button"
+        link_text = html.dashboard.campaign_flash
+        desktop_text = "%s Campaign Summary" % settlement["name"]
+        asset_type = "campaign"
+    elif context == "dashboard_campaign_list":
+        button_class = "gradient_violet"
+        link_text = html.dashboard.campaign_flash + "<b>%s</b><br/>LY %s. Survivors: %s Players: %s" % (settlement["name"], settlement["lantern_year"], settlement["population"], player_count)
+        desktop_text = ""
+        asset_type = "campaign"
+    else:
+        button_class = "gradient_yellow"
+        link_text = html.dashboard.settlement_flash + "<b>%s</b>" % settlement["name"]
+        if "abandoned" in settlement.keys():
+            link_text += ' [ABANDONED]'
+        desktop_text = ""
+        asset_type = "settlement"
+
+    return html.dashboard.view_asset_button.safe_substitute(
+        button_class = button_class,
+        asset_type = asset_type,
+        asset_id = settlement["_id"],
+        asset_name = link_text,
+        desktop_text = desktop_text,
+    )
+
+
+def get_functional_sex(survivor, return_type=None):
+    """ Gets a survivor dict's sex. Takes abilities_and_impairments into
+    account: impairments with the 'reverse_sex' attribute will reverse this. """
+
+    functional_sex = survivor["sex"]
+
+    reverse_sex = False
+    for a in survivor.get("abilities_and_impairments", []):
+        if a in Abilities.get_keys():
+            asset = Abilities.get_asset(a)
+            if asset["type"] in ["impairment", "severe_injury"] and "reverse_sex" in asset.keys():
+                reverse_sex = True
+
+    if reverse_sex:
+        if functional_sex == "M":
+            functional_sex = "F"
+        elif functional_sex == "F":
+            functional_sex = "M"
+
+    if return_type=="html":
+        functional_sex = '<b>%s</b>' % functional_sex
+        if reverse_sex:
+            functional_sex = '<font class="alert">%s</font>' % functional_sex
+
+    return functional_sex
+
+
+class dashboardModel:
+    """ Read model for the dashboard: the user's campaigns, settlements and
+    survivors, rendered as asset links straight from their (projected) mdb
+    documents, without initializing any Settlement or Survivor objects.
+
+    Besides the User's own settlements and survivors (see get_settlements()
+    and get_survivors()), this costs one $in query for the campaign
+    settlements and one aggregation for their player counts. Since nothing
+    gets initialized, nothing gets normalized, either: settlement mins are
+    enforced when somebody actually opens the settlement. """
+
+    def __init__(self, User):
+        self.logger = get_logger()
+        self.User = User
+
+        self.settlements = User.get_settlements()
+        self.survivors = User.get_survivors()
+
+        campaign_ids = set([s["_id"] for s in self.settlements])
+        campaign_ids.update([s["settlement"] for s in self.survivors])
+        campaign_ids = list(campaign_ids)
+
+        self.campaigns = {}
+        for s in mdb.settlements.find({"_id": {"$in": campaign_ids}}, {"name": True, "lantern_year": True, "population": True, "abandoned": True}):
+            self.campaigns[s["_id"]] = s
+        for missing_id in set(campaign_ids) - set(self.campaigns.keys()):
+            self.logger.error("Could not find settlement %s while loading campaigns for %s" % (missing_id, User.get_name_and_id()))
+
+        self.player_counts = {}
+        for c in mdb.survivors.aggregate([
+            {"$match": {"settlement": {"$in": campaign_ids}}},
+            {"$group": {"_id": "$settlement", "players": {"$addToSet": "$email"}}},
+        ]):
+            self.player_counts[c["_id"]] = len(c["players"])
+
+
+    def campaign_links(self):
+        """ Returns the 'dashboard_campaign_list' links for the campaigns that
+        haven't been abandoned, sorted by name. """
+        output = ""
+        campaigns = [c for c in self.campaigns.values() if "abandoned" not in c.keys()]
+        for c in sorted(campaigns, key=operator.itemgetter("name")):
+            output += render_settlement_link(c, context="dashboard_campaign_list", player_count=self.player_counts.get(c["_id"], 0))
+        return output
+
+
+    def settlement_links(self):
+        output = ""
+        for s in self.settlements:
+            output += render_settlement_link(s)
+        return output
+
+
+    def survivor_links(self):
+        output = ""
+        for s in self.survivors:
+            output += render_survivor_link(s, self.campaigns.get(s["settlement"], None))
+        return output
+
+
+
 #
 #   SURVIVOR CLASS
 #
@@ -454,23 +697,49 @@ class Survivor:
         if not survivor_id:
             survivor_id = self.new(params)
 
-        self.survivor = mdb.survivors.find_one({"_id": ObjectId(survivor_id)})
+        identity_map = getattr(self.Session, "identity_map", None)
+        if identity_map is not None:
+            self.survivor = identity_map.load("survivors", survivor_id)
+        else:
+            self.survivor = mdb.survivors.find_one({"_id": ObjectId(survivor_id)})
         if not self.survivor:
             raise Exception("Invalid survivor ID: '%s'" % survivor_id)
 
         settlement_id = self.survivor["settlement"]
         self.Settlement = Settlement(settlement_id=settlement_id, session_object=self.Session, update_mins=self.update_mins)
         if self.Settlement is not None:
-            self.normalize()
+            if identity_map is None:
+                self.normalize()
+            elif not identity_map.is_normalized("survivors", survivor_id):
+                identity_map.mark_normalized("survivors", survivor_id)
+                self.normalize()
 
 
     def __repr__(self):
         return self.get_name_and_id(include_id=False, include_sex=True)
 
 
+    def save(self):
+        """ Saves the survivor. If we've got a Session with an identity map,
+        only the attribs that changed get written. """
+        identity_map = getattr(self.Session, "identity_map", None)
+        if identity_map is not None:
+            identity_map.save("survivors", self.survivor)
+        else:
+            self.survivor["doc_version"] = self.survivor.get("doc_version", 0) + 1
+            mdb.survivors.save(self.survivor)
+
+
     def normalize(self):
-        """ Run this when a Survivor object is initialized: it will enforce
-        the data model and apply settlements defaults to the survivor. """
+        """ Run this when a Survivor object is initialized: it will migrate the
+        survivor to the current data model (if necessary) and apply settlement
+        defaults to the survivor. The survivor is only saved if something
+        actually changed. """
+
+        changed = False
+        if self.survivor.get("schema_version", 0) < survivor_schema_version:
+            self.migrate()
+            changed = True
 
         # see if we need to retire this guy, based on recent updates
         if int(self.survivor["hunt_xp"]) >= 16 and not "retired" in self.survivor.keys():
@@ -480,8 +749,10 @@ class Survivor:
         for ability in ["Dormenatus", "Caratosis", "Lucernae"]:
             if ability in self.survivor["abilities_and_impairments"] and ability not in self.survivor["epithets"]:
                 self.survivor["epithets"].append(ability)
+                changed = True
         if "Twilight Sword" in self.survivor["abilities_and_impairments"] and "Twilight Sword" not in self.survivor["epithets"]:
             self.survivor["epithets"].append("Twilight Sword")
+            changed = True
 
         # normalize weapon proficiency type
         if "weapon_proficiency_type" in self.survivor.keys() and self.survivor["weapon_proficiency_type"] != "":
@@ -490,11 +761,14 @@ class Survivor:
             sanitized = " ".join(sanitized.split())
             if sanitized[-1] == "s":
                 sanitized = sanitized[:-1]
-            self.survivor["weapon_proficiency_type"] = sanitized
-            if self.survivor["weapon_proficiency_type"] == "Fist And Tooth":
-                self.survivor["weapon_proficiency_type"] = "Fist & Tooth"
-        else:
+            if sanitized == "Fist And Tooth":
+                sanitized = "Fist & Tooth"
+            if sanitized != raw_value:
+                self.survivor["weapon_proficiency_type"] = sanitized
+                changed = True
+        elif "weapon_proficiency_type" not in self.survivor.keys():
             self.survivor["weapon_proficiency_type"] = ""
+            changed = True
 
         # check the settlements innovations and auto-add Weapon Specializations
         #   if there are any masteries in the settlement innovations 
@@ -508,6 +782,7 @@ class Survivor:
                         if prof_dict["all_survivors"] not in self.survivor["abilities_and_impairments"]:
                             if self.User.get_preference("apply_weapon_specialization"):
                                 self.survivor["abilities_and_impairments"].append(prof_dict["all_survivors"])
+                                changed = True
                                 self.logger.debug("Auto-applied settlement default '%s' to survivor '%s' of '%s'." % (prof_dict["all_survivors"], self.survivor["name"], self.Settlement.settlement["name"]))
                                 self.Settlement.log_event("Automatically added '%s' to %s's abilities!" % (prof_dict["all_survivors"], self.survivor["name"]))
                 elif innovation_key.split("-")[0].strip() == "Mastery":
@@ -515,8 +790,18 @@ class Survivor:
                     spec_str = "Specialization - %s" % custom_weapon
                     if spec_str not in self.survivor["abilities_and_impairments"]:
                         self.survivor["abilities_and_impairments"].append(spec_str)
+                        changed = True
                         self.logger.debug("Auto-applied settlement default '%s' to survivor '%s'." % (spec_str, self.survivor["name"]))
 
+        if changed:
+            self.save()
+
+
+    def migrate(self):
+        """ Upgrades a legacy survivor document to the current data model and
+        stamps it with the current 'schema_version'. Doesn't save: normalize()
+        does that. """
+
         # if the survivor is legacy data model, he doesn't have a born_in_ly
         #   attrib, so we have to get him one:
         if not "born_in_ly" in self.survivor.keys():
@@ -549,7 +834,7 @@ class Survivor:
                 del self.survivor[a]
                 self.logger.debug("Automatically removed bogus key '%s' from %s." % (a, self.get_name_and_id()))
 
-        mdb.survivors.save(self.survivor)
+        self.survivor["schema_version"] = survivor_schema_version
 
 
     def new(self, params, name="Anonymous", sex="M"):
@@ -634,6 +919,11 @@ class Survivor:
         #   self.survivor with the info we just inserted
         survivor_id = mdb.survivors.insert(survivor_dict)
         self.survivor = mdb.survivors.find_one({"_id": survivor_id})
+        if self.User is not None:
+            self.User.forget_assets()
+        if getattr(self.Session, "identity_map", None) is not None:
+            self.Session.identity_map.forget_family_graph(survivor_dict["settlement"])
+        world.increment_counters({"total_survivors": 1, "live_survivors": 1})
 
         # log the addition or birth of the new survivor
         name_pretty = self.get_name_and_id(include_sex=True, include_id=False)
@@ -677,7 +967,7 @@ class Survivor:
 
         # save the survivor (in case it got changed above), update settlement
         #   mins and log our successful creation
-        mdb.survivors.save(self.survivor)
+        self.save()
         if self.update_mins:
             self.Settlement.update_mins()
         self.logger.info("User '%s' created new survivor %s successfully." % (self.User.user["login"], self.get_name_and_id(include_sex=True)))
@@ -699,6 +989,11 @@ class Survivor:
             gridfs.GridFS(mdb).delete(self.survivor["avatar"])
             self.logger.debug("%s removed an avatar image (%s) from GridFS." % (self.User.user["login"], self.survivor["avatar"]))
         mdb.survivors.remove({"_id": self.survivor["_id"]})
+        world.increment_counters({"total_survivors": -1})
+        if self.User is not None:
+            self.User.forget_assets()
+        if getattr(self.Session, "identity_map", None) is not None:
+            self.Session.identity_map.evict("survivors", self.survivor["_id"])
         self.Settlement.log_event("%s has been Forsaken (and permanently deleted) by %s" % (self, self.User.user["login"] ))
         self.logger.warn("%s removed survivor %s from mdb!" % (self.User.user["login"], self.get_name_and_id()))
 
@@ -707,7 +1002,9 @@ class Survivor:
         """ Markes the survivor 'removed' with a datetime.now(). """
         self.logger.info("[%s] Removing survivor %s" % (self.User, self))
         self.survivor["removed"] = datetime.now()
-        mdb.survivors.save(self.survivor)
+        self.save()
+        if self.User is not None:
+            self.User.forget_assets()
 
         self.Settlement.increment_population(-1)
 
@@ -1017,7 +1314,7 @@ class Survivor:
             current_xp = int(self.survivor["hunt_xp"])
             self.survivor["hunt_xp"] = current_xp + increment_hunt_xp
 
-        mdb.survivors.save(self.survivor)
+        self.save()
 
 
     def update_returning_survivor_years(self, add_year=None):
@@ -1090,7 +1387,7 @@ class Survivor:
                     self.survivor["skip_next_hunt"] = "checked"
                 if "retire" in asset_dict.keys():
                     self.retire()
-                mdb.survivors.save(self.survivor)
+                self.save()
                 return True
             else:
                 return False
@@ -1189,7 +1486,7 @@ class Survivor:
                     self.update_epithets(action="rm", epithet=asset_dict["epithet"])
                 if "cannot_spend_survival" in asset_dict.keys() and "cannot_spend_survival" in self.survivor.keys():
                     del self.survivor["cannot_spend_survival"]
-                mdb.survivors.save(self.survivor)
+                self.save()
                 return True
             else:
                 return False
@@ -1234,7 +1531,7 @@ class Survivor:
                 self.retire()
 
 
-        mdb.survivors.save(self.survivor)
+        self.save()
 
 
     def get_avatar(self, return_type=False):
@@ -1286,7 +1583,7 @@ class Survivor:
         self.survivor["partner_id"] = p_id
         partner = Survivor(survivor_id=p_id, session_object=self.Session)
         partner.survivor["partner_id"] = self.survivor["_id"]
-        mdb.survivors.save(partner.survivor)
+        partner.save()
         self.logger.debug("[%s] %s and %s are now partners." % (self.Settlement, self, partner))
 
 
@@ -1312,7 +1609,7 @@ class Survivor:
         avatar_id = fs.put(processed_image.getvalue(), content_type=file_instance.type, created_by=self.User.user["_id"], created_on=datetime.now())
         self.survivor["avatar"] = ObjectId(avatar_id)
 
-        mdb.survivors.save(self.survivor)
+        self.save()
         self.logger.debug("%s updated the avatar for survivor %s." % (self.User.user["login"], self.get_name_and_id()))
 
 
@@ -1331,22 +1628,15 @@ class Survivor:
     def get_intimacy_partners(self, return_type=None):
         """ Gets a list of survivors with whom the survivor has done the mommy-
         daddy dance. """
-        partners = []
-        for s in self.Settlement.get_survivors():
-            S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-            if self.survivor["_id"] in S.get_parents():
-                partners.extend(S.get_parents())
-        partners = set(partners)
-        try:
-            partners.remove(self.survivor["_id"])
-        except:
-            pass
+        family_graph = self.Settlement.get_family_graph()
+        partners = set(family_graph.partners.get(self.survivor["_id"], []))
 
         if return_type == "html":
             list_of_names = []
             for s_id in partners:
-                S = Survivor(survivor_id=s_id, session_object=self.Session)
-                list_of_names.append(S.survivor["name"])
+                name = family_graph.get_name(s_id)
+                if name is not None:
+                    list_of_names.append(name)
             output = ", ".join(sorted(list_of_names))
             if list_of_names != []:
                 return "<p>%s</p>" % output
@@ -1360,31 +1650,18 @@ class Survivor:
         """ Gets a survivors siblings and returns it as a dictionary (by
         default). Our pretty/HTML return comes back as a list. """
 
-        siblings = {}
-
-        for s in self.Settlement.get_survivors():
-            S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-            for p in self.get_parents():
-                if p in S.get_parents():
-                    siblings[S.survivor["_id"]] = "half"
-            if self.get_parents() != [] and S.get_parents() == self.get_parents():
-                siblings[S.survivor["_id"]] = "full"
-
-        try:
-            del siblings[self.survivor["_id"]]   # remove yourself
-        except:
-            pass
+        family_graph = self.Settlement.get_family_graph()
+        siblings = family_graph.get_siblings(self.survivor["_id"], self.get_parents())
 
         if return_type == "html":
             if siblings == {}:
                 return ""
             sib_list = []
             for s in siblings.keys():
-                S = Survivor(survivor_id=s, session_object=self.Session)
                 if siblings[s] == "half":
-                    sib_list.append("%s (half)" % S.get_name_and_id(include_sex=True, include_id=False))
+                    sib_list.append("%s (half)" % family_graph.get_name(s, include_sex=True))
                 else:
-                    sib_list.append("%s" % S.get_name_and_id(include_sex=True, include_id=False))
+                    sib_list.append("%s" % family_graph.get_name(s, include_sex=True))
             return "<p>%s</p>" % ", ".join(sib_list)
 
         return siblings
@@ -1401,15 +1678,15 @@ class Survivor:
 
         if return_type == "html_select":
             output = ""
+            family_graph = self.Settlement.get_family_graph()
             for role in [("father", "M"), ("mother", "F")]:
                 output += html.survivor.change_ancestor_select_top.safe_substitute(parent_role=role[0], pretty_role=role[0].capitalize())
-                for s in self.Settlement.get_survivors():
-                    S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-                    if S.get_sex() == role[1]:
+                for s_id in family_graph.order:
+                    if family_graph.get_sex(s_id) == role[1]:
                         selected = ""
-                        if S.survivor["_id"] in parents:
+                        if s_id in parents:
                             selected = "selected"
-                        output += html.survivor.change_ancestor_select_row.safe_substitute(parent_id=S.survivor["_id"], parent_name=S.survivor["name"], selected=selected)
+                        output += html.survivor.change_ancestor_select_row.safe_substitute(parent_id=s_id, parent_name=family_graph.get_name(s_id), selected=selected)
                 output += html.survivor.add_ancestor_select_bot
             return output
 
@@ -1420,28 +1697,18 @@ class Survivor:
         """ Returns a dictionary of the survivor's children. """
         children = set()
         children_raw = []
-        survivors = self.Settlement.get_survivors()
-        for s in survivors:
-            survivor_parents = []
-            for p in ["father","mother"]:
-                if p in s.keys():
-                    survivor_parents.append(s[p])
-            for p in ["father","mother"]:
-                if p in s.keys() and s[p] == self.survivor["_id"]:
-                    other_parent = None
-                    survivor_parents.remove(s[p])
-                    if survivor_parents != []:
-                        other_parent = survivor_parents[0]
-                    if other_parent is not None:
-                        try:
-                            O = Survivor(survivor_id=other_parent, session_object=self.Session)
-                            children.add("%s (with %s)" % (s["name"], O.survivor["name"]))
-                            children_raw.append(s)
-                        except:
-                            pass
-                    else:
-                        children.add(s["name"])
-                        children_raw.append(s)
+        family_graph = self.Settlement.get_family_graph()
+        for c in family_graph.children.get(self.survivor["_id"], []):
+            s = family_graph.survivors[c]
+            other_parents = [p for p in family_graph.parents[c] if p != self.survivor["_id"]]
+            if other_parents != []:
+                other_parent_name = family_graph.get_name(other_parents[0])
+                if other_parent_name is not None:
+                    children.add("%s (with %s)" % (s["name"], other_parent_name))
+                    children_raw.append(s)
+            else:
+                children.add(s["name"])
+                children_raw.append(s)
 
         if return_type == "html":
             if children == set():
@@ -1601,28 +1868,7 @@ class Survivor:
     def get_sex(self, return_type=None):
         """ Gets the survivor's sex. Takes abilities_and_impairments into
         account: anything with the 'reverse_sex' attribute will reverse this."""
-
-        functional_sex = self.survivor["sex"]
-
-        reverse_sex = False
-        impairment_keys = self.get_impairments()
-        for i in impairment_keys:
-            if i in Abilities.get_keys():
-                if "reverse_sex" in Abilities.get_asset(i).keys():
-                    reverse_sex = True
-
-        if reverse_sex:
-            if functional_sex == "M":
-                functional_sex = "F"
-            elif functional_sex == "F":
-                functional_sex = "M"
-
-        if return_type=="html":
-            functional_sex = '<b>%s</b>' % functional_sex
-            if reverse_sex:
-                functional_sex = '<font class="alert">%s</font>' % functional_sex
-
-        return functional_sex
+        return get_functional_sex(self.survivor, return_type)
 
 
     def get_returning_survivor_years(self):
@@ -1643,7 +1889,7 @@ class Survivor:
         self.survivor["retired"] = "checked"
         self.survivor["retired_in"] = self.Settlement.settlement["lantern_year"]
         self.Settlement.log_event("%s has retired." % self)
-        mdb.survivors.save(self.survivor)
+        self.save()
 
 
     def death(self, undo_death=False):
@@ -1671,7 +1917,8 @@ class Survivor:
                     self.logger.debug("Could not unset '%s'" % death_key)
                     pass
 
-            mdb.the_dead.remove({"survivor_id": self.survivor["_id"]})
+            if mdb.the_dead.delete_many({"survivor_id": self.survivor["_id"]}).deleted_count > 0:
+                world.increment_counters({"dead_survivors": -1, "live_survivors": 1})
             self.logger.debug("Survivor '%s' removed from the_dead." % self.survivor["name"])
         else:
             self.logger.debug("Survivor '%s' (%s) has died!" % (self.survivor["name"], self.survivor["_id"]))
@@ -1696,6 +1943,7 @@ class Survivor:
 
             if mdb.the_dead.find_one({"survivor_id": self.survivor["_id"]}) is None:
                 mdb.the_dead.insert(death_dict)
+                world.increment_counters({"dead_survivors": 1, "live_survivors": -1})
                 self.logger.debug("Survivor '%s' has joined The Dead." % self.survivor["name"])
                 self.Settlement.settlement["population"] = int(self.Settlement.settlement["population"]) - 1
                 self.Settlement.settlement["death_count"] = int(self.Settlement.settlement["death_count"]) + 1
@@ -1714,7 +1962,7 @@ class Survivor:
         # save the survivor then update settlement mins: you have to do it in
         # this order, or else update_mins() doesn't know about the stiff and the
         # population decrement above won't work.
-        mdb.survivors.save(self.survivor)
+        self.save()
         self.Settlement.update_mins()
 
         if "dead" in self.survivor.keys():
@@ -1753,7 +2001,7 @@ class Survivor:
     def join_hunting_party(self):
         """ Adds a survivor to his settlement's hunting party and saves. """
         self.survivor["in_hunting_party"] = "checked"
-        mdb.survivors.save(self.survivor)
+        self.save()
         self.Settlement.log_event("%s has joined the hunting party." % self.get_name_and_id(include_sex=True, include_id=False))
 
 
@@ -1767,7 +2015,7 @@ class Survivor:
             self.logger.debug("%s set '%s' = '%s' for %s" % (self.User.user["login"], k, attrs_dict[k], self.get_name_and_id()))
             if not self.suppress_event_logging:
                 self.Settlement.log_event("Set %s to '%s' for %s" % (k,attrs_dict[k],self.get_name_and_id(include_id=False,include_sex=True)))
-        mdb.survivors.save(self.survivor)
+        self.save()
 
 
 
@@ -1875,66 +2123,13 @@ class Survivor:
             self.heal(params["heal_survivor"].value)
 
         # this is the big save. This should be the ONLY SAVE we do during a self.modify()
-        mdb.survivors.save(self.survivor)
+        self.save()
 
 
     def asset_link(self, view="survivor", button_class="survivor", link_text=False, include=["hunt_xp", "insanity", "sex", "dead", "retired", "returning"], disabled=False):
         """ Returns an asset link (i.e. html form with button) for the
         survivor. """
-
-        if not link_text:
-            link_text = "<b>%s</b>" % self.survivor["name"]
-            if "sex" in include:
-                link_text += " [%s]" % self.get_sex("html")
-
-        if disabled:
-            link_text += "<br />%s" % self.survivor["email"]
-
-        if include != []:
-            attribs = []
-            if "dead" in include:
-                if "dead" in self.survivor.keys():
-                    button_class = "grey"
-                    attribs.append("Dead")
-
-            if "retired" in include:
-                if "retired" in self.survivor.keys():
-                    button_class = "warn"
-                    attribs.append("Retired")
-
-            if "returning" in include:
-                if self.Settlement.get_ly() in self.get_returning_survivor_years():
-                    attribs.append("Returning Survivor")
-
-            if "settlement_name" in include:
-                attribs.append(self.Settlement.settlement["name"])
-
-            if "hunt_xp" in include:
-                attribs.append("XP: %s" % self.survivor["hunt_xp"])
-
-            if "insanity" in include:
-                attribs.append("Insanity: %s" % self.survivor["Insanity"])
-
-            if attribs != []:
-                suffix = "<br /> "
-                suffix += ", ".join(attribs)
-                suffix += ""
-                link_text += suffix
-
-        if disabled:
-            disabled = "disabled"
-            button_class= "unclickable"
-
-        output = html.dashboard.view_asset_button.safe_substitute(
-            button_class = button_class,
-            asset_type = view,
-            asset_id = self.survivor["_id"],
-            asset_name = link_text,
-            disabled = disabled,
-            desktop_text = "",
-        )
-
-        return output
+        return render_survivor_link(self.survivor, self.Settlement.settlement, view, button_class, link_text, include, disabled)
 
 
     def render_html_form(self):
@@ -2081,6 +2276,155 @@ class Survivor:
 
 
 
+#
+#   FAMILY GRAPH
+#
+
+class familyGraph:
+    """ An in-memory index of a settlement's family relationships. Build it
+    with an iterable of survivor dicts (use Settlement.get_family_graph() to
+    get one) and it gives you parents, children, intimacy partners and
+    generations without initializing any Survivor objects. """
+
+    projection = {
+        "name": True,
+        "sex": True,
+        "father": True,
+        "mother": True,
+        "born_in_ly": True,
+        "created_on": True,
+        "dead": True,
+        "died_in": True,
+        "abilities_and_impairments": True,
+    }
+
+    def __init__(self, survivors):
+        self.logger = get_logger()
+        self.survivors = {}         # _id -> survivor dict
+        self.order = []             # _id's in the order we got them
+        self.parents = {}           # child _id -> [father, mother]
+        self.children = defaultdict(list)   # parent _id -> [child _id's]
+        self.partners = defaultdict(set)    # parent _id -> co-parent _id's
+        self.generations = None
+        self.genealogy = None       # see Settlement.get_genealogy()
+
+        for s in survivors:
+            self.survivors[s["_id"]] = s
+            self.order.append(s["_id"])
+            self.parents[s["_id"]] = [s[p] for p in ["father","mother"] if p in s.keys()]
+
+        for s_id in self.order:
+            parents = self.parents[s_id]
+            for p in parents:
+                self.children[p].append(s_id)
+                for other_parent in parents:
+                    if other_parent != p:
+                        self.partners[p].add(other_parent)
+
+    def get_survivor(self, s_id):
+        """ Returns a survivor dict. Parents who have been removed from the
+        settlement aren't in the graph, so we go get those individually. """
+        if s_id not in self.survivors:
+            s = mdb.survivors.find_one({"_id": s_id}, self.projection)
+            if s is None:
+                return None
+            self.survivors[s_id] = s
+        return self.survivors[s_id]
+
+    def get_sex(self, s_id):
+        """ Same as Survivor.get_sex(), i.e. takes 'reverse_sex' impairments
+        into account. """
+        s = self.get_survivor(s_id)
+        functional_sex = s["sex"]
+        for a in s.get("abilities_and_impairments", []):
+            if a in Abilities.get_keys():
+                asset = Abilities.get_asset(a)
+                if asset["type"] in ["impairment","severe_injury"] and "reverse_sex" in asset.keys():
+                    if functional_sex == "M":
+                        functional_sex = "F"
+                    elif functional_sex == "F":
+                        functional_sex = "M"
+                    break
+        return functional_sex
+
+    def get_name(self, s_id, include_sex=False):
+        """ Same as Survivor.get_name_and_id(include_id=False). Returns None if
+        the survivor can't be found. """
+        s = self.get_survivor(s_id)
+        if s is None:
+            return None
+        if include_sex:
+            return "%s [%s]" % (s["name"], self.get_sex(s_id))
+        return s["name"]
+
+    def get_siblings(self, s_id, parents):
+        """ Returns a dict of sibling _id's whose values are "full" or "half".
+        Pass in the survivor's parents, since they might have changed since the
+        graph was built. """
+        siblings = {}
+        for p in parents:
+            for c in self.children.get(p, []):
+                if c == s_id:
+                    continue
+                if self.parents[c] == parents:
+                    siblings[c] = "full"
+                else:
+                    siblings[c] = "half"
+        return siblings
+
+    def get_generations(self):
+        """ Returns a dict of survivor _id's and their generation (founders are
+        generation zero). Survivors whose generation can't be worked out (e.g.
+        because they have no family) aren't in the dict. """
+
+        if self.generations is not None:
+            return self.generations
+
+        generations = {}
+        for s_id in self.order:
+            s = self.survivors[s_id]
+            if self.parents[s_id] == [] and s.get("born_in_ly") in [0,1]:
+                generations[s_id] = 0
+
+        queue = deque(generations.keys())
+        while True:
+
+            # walk down from everyone whose generation we know: a child is one
+            #   generation younger than its father (or mother, if the father's
+            #   generation isn't known)
+            while queue:
+                s_id = queue.popleft()
+                for c in self.children.get(s_id, []):
+                    if c in generations:
+                        continue
+                    s = self.survivors[c]
+                    if "father" in s.keys() and s["father"] in generations:
+                        generations[c] = generations[s["father"]] + 1
+                    elif "mother" in s.keys() and s["mother"] in generations:
+                        generations[c] = generations[s["mother"]] + 1
+                    else:
+                        continue
+                    queue.append(c)
+
+            # survivors who joined the settlement later and then had children
+            #   are the same generation as their partner
+            for s_id in self.order:
+                if s_id in generations or self.parents[s_id] != []:
+                    continue
+                for p in self.partners.get(s_id, []):
+                    if p in generations:
+                        generations[s_id] = generations[p]
+                        queue.append(s_id)
+                        break
+
+            if not queue:
+                break
+
+        self.generations = generations
+        return self.generations
+
+
+
 #
 #   SETTLEMENT CLASS
 #
@@ -2104,16 +2448,54 @@ class Settlement:
         if not settlement_id:
             settlement_id = self.new(name, campaign)
 
-        self.settlement = mdb.settlements.find_one({"_id": ObjectId(settlement_id)})
-        if self.settlement is not None and update_mins:
-            self.update_mins()
+        # this gets built the first time somebody asks for it, unless we've
+        #   got an identity map: see get_family_graph()
+        self.family_graph = None
+
+        # settlements at the current schema_version don't get normalized (i.e.
+        #   update_mins()) when they're loaded: the write paths that can break
+        #   the minimums call update_mins() themselves. If we've got a Session
+        #   object with an identity map, each settlement only gets loaded (and
+        #   migrated) once per request
+        identity_map = getattr(self.Session, "identity_map", None)
+        if identity_map is not None:
+            self.settlement = identity_map.load("settlements", settlement_id)
+            if self.settlement is not None and update_mins and self.needs_migration() and not identity_map.is_normalized("settlements", settlement_id):
+                identity_map.mark_normalized("settlements", settlement_id)
+                self.update_mins()
+        else:
+            self.settlement = mdb.settlements.find_one({"_id": ObjectId(settlement_id)})
+            if self.settlement is not None and update_mins and self.needs_migration():
+                self.update_mins()
 
     def __repr__(self):
         return self.get_name_and_id()
 
 
+    def save(self):
+        """ Saves the settlement. If we've got a Session with an identity map,
+        only the attribs that changed get written. """
+        identity_map = getattr(self.Session, "identity_map", None)
+        if identity_map is not None:
+            identity_map.save("settlements", self.settlement)
+        else:
+            self.settlement["doc_version"] = self.settlement.get("doc_version", 0) + 1
+            mdb.settlements.save(self.settlement)
+
+
+    def needs_migration(self):
+        """ Returns True if the settlement's document predates the current data
+        model, i.e. if it has to be normalized when it's loaded. Anything that
+        can leave a current settlement under its minimums (e.g. a survivor
+        edit that happens outside of the Settlement) either calls update_mins()
+        afterwards or unsets the settlement's 'schema_version'. """
+        return self.settlement.get("schema_version", 0) < settlement_schema_version
+
+
     def log_event(self, msg):
-        """ Logs a settlement event to mdb.settlement_events. """
+        """ Logs a settlement event to mdb.settlement_events. If we've got a
+        Session with an event buffer, the event is written when the request is
+        finished. """
         d = {
             "created_on": datetime.now(),
             "created_by": self.User.user["_id"],
@@ -2121,7 +2503,11 @@ class Settlement:
             "ly": self.settlement["lantern_year"],
             "event": msg,
         }
-        mdb.settlement_events.insert(d)
+        event_buffer = getattr(self.Session, "event_buffer", None)
+        if event_buffer is not None:
+            event_buffer.append(d)
+        else:
+            mdb.settlement_events.insert(d)
         self.logger.debug("Settlement event logged for %s" % self.get_name_and_id())
 
 
@@ -2160,6 +2546,9 @@ class Settlement:
         # create the settlement and update the Settlement obj
         settlement_id = mdb.settlements.insert(new_settlement_dict)
         self.settlement = mdb.settlements.find_one({"_id": settlement_id})
+        if self.User is not None:
+            self.User.forget_assets()
+        world.increment_counters(world.settlement_counters(self.settlement))
 
         # log the creation
         self.logger.info("[%s] New '%s' campaign settlement '%s' ('%s') created!" % (self.User, campaign, name, settlement_id))
@@ -2246,7 +2635,7 @@ class Settlement:
         new_pop = current_pop + amount
         self.log_event("Settlement population automatically adjusted by %s" % amount)
         self.settlement["population"] = current_pop
-        mdb.settlements.save(self.settlement)
+        self.update_mins()  # this is a save
         self.logger.debug("[%s] auto-incremented settlement %s population by %s" % (self.User, self, amount))
 
 
@@ -2290,8 +2679,12 @@ class Settlement:
         for survivor in self.get_survivors():
             S = Survivor(survivor_id=survivor["_id"], session_object=self.Session)
             S.remove()
+        if not "removed" in self.settlement.keys() and not "abandoned" in self.settlement.keys():
+            world.increment_counters({"active_settlements": -1, "abandoned_settlements": 1})
         self.settlement["removed"] = datetime.now()
-        mdb.settlements.save(self.settlement)
+        self.save()
+        if self.User is not None:
+            self.User.forget_assets()
         self.log_event("Removed settlement!")
         self.logger.warn("[%s] Finished marking %s as 'removed'." % (self.User, self))
 
@@ -2307,6 +2700,11 @@ class Settlement:
             S.delete(run_valkyrie=False)
         admin.valkyrie()
         mdb.settlements.remove({"_id": self.settlement["_id"]})
+        world.increment_counters(world.settlement_counters(self.settlement, -1))
+        if self.User is not None:
+            self.User.forget_assets()
+        if getattr(self.Session, "identity_map", None) is not None:
+            self.Session.identity_map.evict("settlements", self.settlement["_id"])
         self.logger.warn("[%s] Deleted %s from mdb!" % (self.User, self))
 
 
@@ -2342,7 +2740,7 @@ class Settlement:
         self.enforce_data_model()
         if self.User.get_preference("update_timeline"):
             self.update_timeline_with_story_events()
-        mdb.settlements.save(self.settlement)
+        self.save()
 
 
     def get_story_events(self):
@@ -2451,6 +2849,8 @@ class Settlement:
             self.settlement["timeline"].append(year_zero)
             self.logger.debug("Added errata LY 0 to %s" % self.get_name_and_id())
 
+        self.settlement["schema_version"] = settlement_schema_version
+
 
 
     def get_name_and_id(self):
@@ -2518,7 +2918,7 @@ class Settlement:
         self.log_event("%s has mastered %s!" % (master, weapon))
         self.log_event("'%s' added to settlement Innovations!" % mastery_string)
         self.logger.debug("[%s] added '%s' to %s Innovations! (Survivor: %s)" % (self.User, mastery_string, self, master))
-        mdb.settlements.save(self.settlement)
+        self.save()
 
 
     def get_ancestors(self, return_type=None, survivor_id=False):
@@ -2529,13 +2929,13 @@ class Settlement:
             return "NOT IMPLEMENTED YET"
 
         if return_type == "html_parent_select":
+            family_graph = self.get_family_graph()
             male_parent = False
             female_parent = False
-            for s in self.get_survivors():
-                S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-                if S.get_sex() == "M" and "dead" not in S.survivor.keys():
+            for s_id in family_graph.order:
+                if family_graph.get_sex(s_id) == "M" and "dead" not in family_graph.survivors[s_id].keys():
                     male_parent = True
-                elif S.get_sex() == "F" and "dead" not in S.survivor.keys():
+                elif family_graph.get_sex(s_id) == "F" and "dead" not in family_graph.survivors[s_id].keys():
                     female_parent = True
         else:
             return False
@@ -2546,35 +2946,66 @@ class Settlement:
             output = html.survivor.add_ancestor_top
             for role in [("father", "M"), ("mother", "F")]:
                 output += html.survivor.add_ancestor_select_top.safe_substitute(parent_role=role[0], pretty_role=role[0].capitalize())
-                for s in self.get_survivors():
-                    S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-                    if S.get_sex() == role[1] and "dead" not in S.survivor.keys():
-                        output += html.survivor.add_ancestor_select_row.safe_substitute(parent_id=S.survivor["_id"], parent_name=S.survivor["name"])
+                for s_id in family_graph.order:
+                    if family_graph.get_sex(s_id) == role[1] and "dead" not in family_graph.survivors[s_id].keys():
+                        output += html.survivor.add_ancestor_select_row.safe_substitute(parent_id=s_id, parent_name=family_graph.get_name(s_id))
                 output += html.survivor.add_ancestor_select_bot
             output += html.survivor.add_ancestor_bot
             return output
 
 
+    def get_family_graph(self):
+        """ Returns a familyGraph of the settlement's survivors. It's built from
+        a single (projected) query the first time it's needed. If we've got a
+        Session with an identity map, it's kept there, so every Settlement
+        object for this settlement shares it for the rest of the request (or
+        until one of its survivors gets saved). Otherwise, it's re-used for the
+        life of the Settlement object. """
+
+        identity_map = getattr(self.Session, "identity_map", None)
+        if identity_map is not None:
+            family_graph = identity_map.get_family_graph(self.settlement["_id"])
+            if family_graph is None:
+                family_graph = self.build_family_graph()
+                identity_map.set_family_graph(self.settlement["_id"], family_graph)
+            return family_graph
+
+        if self.family_graph is None:
+            self.family_graph = self.build_family_graph()
+        return self.family_graph
+
+
+    def build_family_graph(self):
+        survivors = mdb.survivors.find(
+            {"removed": {"$exists": False}, "settlement": self.settlement["_id"]},
+            familyGraph.projection,
+        ).sort("name")
+        return familyGraph(survivors)
+
+
     def get_genealogy(self, return_type=False):
         """ Creates a dictionary of the settlement's various clans. """
 
+        family_graph = self.get_family_graph()
+
         # helper func to render survivors as html spans
-        def survivor_to_span(S, display="inline"):
+        def survivor_to_span(s_id, display="inline"):
             """ Turns a survivor into an HTML span for genealogy use. """
+            s = family_graph.get_survivor(s_id)
             span = ""
             class_color = "green_text"
             born = ""
-            if "born_in_ly" in S.survivor.keys():
-                born = "- born in LY %s" % S.survivor["born_in_ly"]
+            if "born_in_ly" in s.keys():
+                born = "- born in LY %s" % s["born_in_ly"]
             dead = ""
-            if "dead" in S.survivor.keys():
+            if "dead" in s.keys():
                 class_color = "maroon_text"
                 dead = "- died"
-                if "died_in" in S.survivor.keys():
-                    dead = "- died in LY %s" % S.survivor["died_in"]
+                if "died_in" in s.keys():
+                    dead = "- died in LY %s" % s["died_in"]
 
             span += html.settlement.genealogy_survivor_span.safe_substitute(
-                name=S.get_name_and_id(include_sex=True, include_id=False),
+                name=family_graph.get_name(s_id, include_sex=True),
                 dead = dead,
                 born = born,
                 class_color=class_color,
@@ -2582,161 +3013,87 @@ class Settlement:
             )
             return span
 
-        # now, start the insanity:
-        genealogy = {"has_no_parents": set(), "is_a_parent": set(), "has_no_children": set(), "no_family": set(), "founders": set(), "parent_pairs": set(), "tree": [], "has_parents": set(),}
-
-        survivors = list(self.get_survivors())
-
-        # determine who has no parents
-        for s in survivors:
-            if not "father" in s.keys() and not "mother" in s.keys():
-                genealogy["has_no_parents"].add(s["_id"])
-            else:
-                genealogy["has_parents"].add(s["_id"])
-
-        # determine who IS a parent
-        for s in survivors:
-            for parent in ["father","mother"]:
-                if parent in s.keys():
-                    genealogy["is_a_parent"].add(s[parent])
-
-        # ...and use that to figure out who is NOT a parent
-        for s in survivors:
-            if s["_id"] not in genealogy["is_a_parent"]:
-                genealogy["has_no_children"].add(s["_id"])
-
-        # ...and then create our list of no family survivors
-        for s in survivors:
-            if s["_id"] in genealogy["has_no_parents"] and s["_id"] in genealogy["has_no_children"]:
-                genealogy["no_family"].add(s["_id"])
-
-        # ...and finally determine who the settlement founders are
-        for s in survivors:
-            if s["_id"] in genealogy["has_no_parents"] and s["born_in_ly"] in [0,1]:
-                genealogy["founders"].add(s["_id"])
-
-        # create a set of parent "pairs"; also include single parents, in case
-        #   anyone's been a clever dick (looking at you, Kendal)
-        for s in survivors:
-            if "father" in s.keys() and "mother" in s.keys():
-                genealogy["parent_pairs"].add((s["father"], s["mother"]))
-            if "father" in s.keys() and "mother" not in s.keys():
-                genealogy["parent_pairs"].add((s["father"]))
-            if "mother" in s.keys() and "father" not in s.keys():
-                genealogy["parent_pairs"].add((s["mother"]))
-
-        generation = 0
-        generations = {}
-        for s in genealogy["founders"]:
-#            self.logger.debug("%s is a founder." % s)
-            generations[s] = 0
-
-        everyone = list(self.get_survivors("chronological_order").sort("created_on",-1))
-        loops = 0
-        while everyone != []:
-            for s in everyone:
-                if s["_id"] in generations.keys():
-                    everyone.remove(s)
-                elif s["_id"] in genealogy["founders"]:
-                    everyone.remove(s)
-                elif s["_id"] in genealogy["no_family"]:
-                    everyone.remove(s)
-                elif "father" in s.keys() and s["father"] in generations.keys():
-                    generations[s["_id"]] = generations[s["father"]] + 1
-                elif "mother" in s.keys() and s["mother"] in generations.keys():
-                    generations[s["_id"]] = generations[s["mother"]] + 1
-                # and now we start the wild and wolly batshit insanity for
-                # handling incomplete records and single parents
-                elif s["_id"] in genealogy["is_a_parent"]:
-                    for parent_pair in genealogy["parent_pairs"]:
-                        if type(parent_pair) == tuple and s["_id"] in parent_pair:
-#                            self.logger.debug("%s belongs to parent pair %s" % (s["name"], parent_pair))
-                            for partner in parent_pair:
-                                if partner in generations.keys():
-                                    generations[s["_id"]] = generations[partner]
-                    S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-                    for child in S.get_children():
-                        if child["_id"] in generations.keys():
-                            generations[s["_id"]] = generations[child["_id"]] + 1
+        if family_graph.genealogy is not None:
+            genealogy = family_graph.genealogy
+        else:
+            genealogy = {"has_no_parents": set(), "is_a_parent": set(), "has_no_children": set(), "no_family": set(), "founders": set(), "parent_pairs": set(), "tree": [], "has_parents": set(),}
+
+            for s_id in family_graph.order:
+                s = family_graph.survivors[s_id]
+                if family_graph.parents[s_id] == []:
+                    genealogy["has_no_parents"].add(s_id)
+                    if s.get("born_in_ly") in [0,1]:
+                        genealogy["founders"].add(s_id)
                 else:
-                    if loops >= 5:
-                        pass
-                        self.logger.debug("Unable to determine generation for %s after %s loops." % (s["name"], loops))
-            loops += 1
-            if loops == 10:
-                self.logger.error("Settlement %s hit %s loops while calculating generations!" % (self.get_name_and_id(), loops))
-                self.logger.debug(generations)
-                for survivor in everyone:
-                    self.logger.error("Could not determine generation for '%s' -> %s" % (survivor["name"], survivor["_id"]))
-                    genealogy["no_family"].add(survivor["_id"])
-
-        # now, finally, start creating representations of the genealogy
-        genealogy["tree"] = ""
-        genealogy["summary"] = ""
-        for generation in sorted(list(set(generations.values())))[:-1]:
-            genealogy["summary"] += '<h4>Generation %s</h4>' % generation
-            generators = set()
-            for s, s_gen in generations.iteritems():
-                if s_gen == generation:
-                    for parent_pair in genealogy["parent_pairs"]:
-                        if type(parent_pair) == tuple and s in parent_pair:
-                            generators.add(parent_pair)
-            for parent_pair in generators:
-                try:
-                    parent_pair_list = [Survivor(survivor_id=p, session_object=self.Session).get_name_and_id(include_id=False, include_sex=True) for p in parent_pair]
-                except TypeError:
-                    parent_pair_list = [Survivor(survivor_id=p, session_object=self.Session).get_name_and_id(include_id=False, include_sex=True)]
-                parent_pair_string = " and ".join(parent_pair_list)
-                children = []
-                for s in genealogy["has_parents"]:
-                    if generations[s] == generation + 1:
-                        S = Survivor(survivor_id=s, session_object=self.Session)
-                        parent_tuple = None
-                        if "father" in S.survivor.keys() and "mother" in S.survivor.keys():
-                            parent_tuple = (S.survivor["father"], S.survivor["mother"])
-                        if "father" in S.survivor.keys() and "mother" not in S.survivor.keys():
-                            parent_tuple = (S.survivor["father"])
-                        if "father" not in S.survivor.keys() and "mother" in S.survivor.keys():
-                            parent_tuple = (S.survivor["mother"])
-                        if parent_tuple == parent_pair:
-                            children.append(S)
-
-                def generation_html(children_list, recursion=False):
-                    """ Helper that makes ul's of survivors. """
-                    output = '<ul>\n'
-                    if children_list == []:
-                        return ""
-                    for child in children_list:
-                        grand_children = [Survivor(survivor_id=c["_id"], session_object=self.Session) for c in child.get_children()]
-                        if not recursion:
-                            gc_html = ""
-                        else:
-                            gc_html = generation_html(grand_children, recursion=recursion)
-                        output += '\n\t<a><li>%s</li></a>\n' % survivor_to_span(child)
-                    output += '</ul>\n'
-                    return output
-
-                if children != []:
-                    genealogy["tree"] += '\t<div class="tree desktop_only">\n<ul><li><a>%s</a>\n\t\t' % parent_pair_string
-                    genealogy["tree"] += generation_html(children)
-                    genealogy["tree"] += '\n\t</li>\n</ul></div><!-- tree -->\n'
-                    genealogy["summary"] += '<p>&ensp; %s gave birth to:</p>' % parent_pair_string
-                    genealogy["summary"] += "<p>%s</p>" % generation_html(children, recursion=False)
-
-            genealogy["summary"] += "<hr/>"
-            genealogy["tree"] += '<hr class="desktop_only"/>'
-
-
+                    genealogy["has_parents"].add(s_id)
+                if family_graph.children.get(s_id, []) == []:
+                    genealogy["has_no_children"].add(s_id)
+
+                # create a set of parent "pairs"; also include single parents,
+                #   in case anyone's been a clever dick (looking at you, Kendal)
+                parents = family_graph.parents[s_id]
+                genealogy["is_a_parent"].update(parents)
+                if len(parents) == 2:
+                    genealogy["parent_pairs"].add(tuple(parents))
+                elif len(parents) == 1:
+                    genealogy["parent_pairs"].add(parents[0])
+
+            genealogy["no_family"] = genealogy["has_no_parents"] & genealogy["has_no_children"]
+
+            generations = family_graph.get_generations()
+            for s_id in family_graph.order:
+                if s_id not in generations and s_id not in genealogy["no_family"]:
+                    self.logger.error("Could not determine generation for '%s' -> %s" % (family_graph.survivors[s_id]["name"], s_id))
+                    genealogy["no_family"].add(s_id)
+
+            # now, finally, start creating representations of the genealogy
+            genealogy["tree"] = ""
+            genealogy["summary"] = ""
+            for generation in sorted(list(set(generations.values())))[:-1]:
+                genealogy["summary"] += '<h4>Generation %s</h4>' % generation
+                generators = set()
+                for s, s_gen in generations.iteritems():
+                    if s_gen == generation:
+                        for partner in family_graph.partners.get(s, []):
+                            for parent_pair in [(s, partner), (partner, s)]:
+                                if parent_pair in genealogy["parent_pairs"]:
+                                    generators.add(parent_pair)
+                for parent_pair in generators:
+                    parent_pair_string = " and ".join([family_graph.get_name(p, include_sex=True) for p in parent_pair])
+                    children = []
+                    for c in family_graph.children.get(parent_pair[0], []):
+                        if tuple(family_graph.parents[c]) == parent_pair and generations.get(c) == generation + 1:
+                            children.append(c)
+
+                    def generation_html(children_list):
+                        """ Helper that makes ul's of survivors. """
+                        output = '<ul>\n'
+                        if children_list == []:
+                            return ""
+                        for child in children_list:
+                            output += '\n\t<a><li>%s</li></a>\n' % survivor_to_span(child)
+                        output += '</ul>\n'
+                        return output
+
+                    if children != []:
+                        genealogy["tree"] += '\t<div class="tree desktop_only">\n<ul><li><a>%s</a>\n\t\t' % parent_pair_string
+                        genealogy["tree"] += generation_html(children)
+                        genealogy["tree"] += '\n\t</li>\n</ul></div><!-- tree -->\n'
+                        genealogy["summary"] += '<p>&ensp; %s gave birth to:</p>' % parent_pair_string
+                        genealogy["summary"] += "<p>%s</p>" % generation_html(children)
+
+                genealogy["summary"] += "<hr/>"
+                genealogy["tree"] += '<hr class="desktop_only"/>'
+
+            family_graph.genealogy = genealogy
 
 
         if return_type == "html_no_family":
             output = html.settlement.genealogy_headline.safe_substitute(value="Founders")
-            sorted_survivor_list = mdb.survivors.find({"_id": {"$in": list(genealogy["founders"])}}).sort("created_on")
-            for s in sorted_survivor_list:
-                S = Survivor(survivor_id=s["_id"], session_object=self.Session)
-                output += survivor_to_span(S, display="block")
+            founders = [family_graph.survivors[s_id] for s_id in genealogy["founders"]]
+            for s in sorted(founders, key=lambda s: s.get("created_on")):
+                output += survivor_to_span(s["_id"], display="block")
             output += html.settlement.genealogy_headline.safe_substitute(value="Undetermined Lineage")
-            sorted_survivor_list = mdb.survivors.find({"_id": {"$in": list(genealogy["no_family"])}}).sort("created_on")
             return output
         if return_type == "html_tree":
             return genealogy["tree"]
@@ -2759,7 +3116,7 @@ class Settlement:
             else:
                 storage.append(capwords(i))
         self.settlement["storage"] = storage
-        mdb.settlements.save(self.settlement)
+        self.save()
 
         if self.settlement["storage"] == []:
             return ""
@@ -3687,13 +4044,12 @@ class Settlement:
                 if d in Disorders.get_keys() and "on_return" in Disorders.get_asset(d):
                     for k, v in Disorders.get_asset(d)["on_return"].iteritems():
                         S.survivor[k] = v
-                    mdb.survivors.save(S.survivor)
+                    S.save()
 
         # remove "skip_next_hunt" from anyone who has it but didn't return
         for survivor in self.get_survivors(exclude=returning_survivor_id_list, exclude_dead=False):
             if "skip_next_hunt" in survivor.keys():
-                del survivor["skip_next_hunt"]
-                mdb.survivors.save(survivor)
+                mdb.survivors.update_one({"_id": survivor["_id"]}, {"$unset": {"skip_next_hunt": ""}, "$inc": {"doc_version": 1}})
 
         self.log_event("The hunting party (%s) returned." % ", ".join(returning_survivor_name_list))
 
@@ -3725,7 +4081,7 @@ class Settlement:
             if target_attrib != "Brain Event Damage" and S.survivor[target_attrib] < 0:
                 S.survivor[target_attrib] = 0
 
-            mdb.survivors.save(S.survivor)
+            S.save()
 
     def get_recently_added_items(self):
         """ Returns the three items most recently appended to storage. """
@@ -4262,6 +4618,7 @@ class Settlement:
         self.logger.debug("[%s] Updated application killboard: %s (LY %s)" % (self, monster_desc, current_ly))
 
         self.settlement["defeated_monsters"].append(monster_desc)
+        world.increment_counters(world.kill_counters(monster_desc))
         self.logger.debug("%s defeated by %s" % (monster_desc, self))
         self.log_event("%s defeated!" % monster_desc)
 
@@ -4319,7 +4676,7 @@ class Settlement:
 
         self.log_event("%s added to settlement %s!" % (game_asset_key, asset_class.title()))
 
-        mdb.settlements.save(self.settlement)
+        self.save()
 
 
     def rm_game_asset(self, asset_class, game_asset_key=None):
@@ -4329,8 +4686,10 @@ class Settlement:
 #        exec "Asset = %s" % asset_class.capitalize()   # this isn't necessary yet
 
         self.settlement[asset_class].remove(game_asset_key)
+        if asset_class == "defeated_monsters":
+            world.increment_counters(world.kill_counters(game_asset_key, -1))
         self.logger.debug("%s removed asset '%s' from settlement '%s' (%s) successfully!" % (self.User.user["login"], game_asset_key, self.settlement["name"], self.settlement["_id"]))
-        mdb.settlements.save(self.settlement)
+        self.save()
 
 
     def modify(self, params):
@@ -4381,6 +4740,8 @@ class Settlement:
                 self.update_milestones([k.value for k in params[p]])
             elif p == "abandon_settlement":
                 self.log_event("Settlement abandoned!")
+                if not "removed" in self.settlement.keys() and not "abandoned" in self.settlement.keys():
+                    world.increment_counters({"active_settlements": -1, "abandoned_settlements": 1})
                 self.settlement["abandoned"] = datetime.now()
             elif p == "increment_lantern_year":
                 self.update_timeline(increment=True)
@@ -4458,6 +4819,8 @@ class Settlement:
     def render_html_event_log(self):
         """ Renders the settlement's event log as HTMl. """
 
+        if getattr(self.Session, "event_buffer", None) is not None:
+            self.Session.event_buffer.flush()
         event_log_entries = list(mdb.settlement_events.find({"settlement_id": self.settlement["_id"]}).sort("created_by",-1))
         if event_log_entries == []:
             event_log_entries.append({"ly":"-","event":"Nothing here yet!"})
@@ -4651,36 +5014,11 @@ class Settlement:
         if update_mins:
             self.update_mins()  # update settlement mins before we create any text
 
-        if context == "campaign_summary":
-            button_class = "yellow floating_asset_button"
-            link_text = html.dashboard.settlement_flash
-            desktop_text = "Edit %s" % self.settlement["name"]
-            asset_type = "settlement"
-        elif context == "asset_management":
-            button_class = "gradient_purple floating_asset_button"
-            link_text = html.dashboard.campaign_flash
-            desktop_text = "%s Campaign Summary" % self.settlement["name"]
-            asset_type = "campaign"
-        elif context == "dashboard_campaign_list":
-            button_class = "gradient_violet"
-            link_text = html.dashboard.campaign_flash + "<b>%s</b><br/>LY %s. Survivors: %s Players: %s" % (self.settlement["name"], self.settlement["lantern_year"], self.settlement["population"], self.get_players(count_only=True))
-            desktop_text = ""
-            asset_type = "campaign"
-        else:
-            button_class = "gradient_yellow"
-            link_text = html.dashboard.settlement_flash + "<b>%s</b>" % self.settlement["name"]
-            if "abandoned" in self.settlement.keys():
-                link_text += ' [ABANDONED]'
-            desktop_text = ""
-            asset_type = "settlement"
-
-        return html.dashboard.view_asset_button.safe_substitute(
-            button_class = button_class,
-            asset_type = asset_type,
-            asset_id = self.settlement["_id"],
-            asset_name = link_text,
-            desktop_text = desktop_text,
-        )
+        player_count = 0
+        if context == "dashboard_campaign_list":
+            player_count = self.get_players(count_only=True)
+
+        return render_settlement_link(self.settlement, context, player_count)
 
 
 
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+#   standard
+from bson.objectid import ObjectId
+import calendar
+from datetime import datetime
+import errno
+import os
+import re
+import tempfile
+
+#   NumPy is optional: without it, world.py does its math in mdb
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#   custom
+from utils import mdb, get_logger, load_settings
+
+settings = load_settings()
+
+
+#
+#   Column definitions
+#
+
+#   the numeric attribs we keep a column of. List attribs are stored as their
+#   length; anything that isn't a number or a list is stored as NaN
+column_attribs = {
+    "settlements": [
+        "lantern_year", "population", "death_count", "survival_limit",
+        "lost_settlements", "milestone_story_events", "storage",
+        "defeated_monsters", "expansions", "innovations",
+    ],
+    "survivors": [
+        "hunt_xp", "Courage", "Understanding", "Insanity", "disorders",
+        "abilities_and_impairments", "fighting_arts",
+    ],
+}
+
+#   these are stored as 1 if the document has the attrib and 0 if it doesn't
+flag_attribs = {
+    "settlements": ["removed", "abandoned"],
+    "survivors": ["dead"],
+}
+
+
+#   what a column value was in mdb. world.attrib_as_number() converts all of
+#   these, but only real numbers match a $gt in a query (see get_sample()) and
+#   only KIND_NUMBER, KIND_LIST, KIND_BOOL, KIND_INT_STRING and KIND_DATE
+#   convert to a long (see get_values())
+KIND_NONE, KIND_NUMBER, KIND_LIST, KIND_BOOL, KIND_INT_STRING, KIND_FLOAT_STRING, KIND_DATE = range(7)
+
+int_string = re.compile(r"^[+-]?\d+$")
+float_string = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+
+
+def get_column_value(document, attrib):
+    """ Turns a document's 'attrib' into a (value, kind) tuple that fits in a
+    float64 column and an int8 column, converting it the same way that
+    world.attrib_as_number() ($convert) does: numbers are numbers, lists are
+    their length, bools are 1 or 0, numeric strings are numbers, dates are
+    milliseconds since the epoch and everything else is NaN. """
+
+    value = document.get(attrib, None)
+    if type(value) == list:
+        return float(len(value)), KIND_LIST
+    elif type(value) == bool:
+        return float(value), KIND_BOOL
+    elif type(value) in [int, long, float]:
+        return float(value), KIND_NUMBER
+    elif type(value) in [str, unicode]:
+        if int_string.match(value):
+            return float(value), KIND_INT_STRING
+        elif float_string.match(value):
+            return float(value), KIND_FLOAT_STRING
+    elif type(value) == datetime:
+        return float(calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000), KIND_DATE
+    return float("nan"), KIND_NONE
+
+
+def get_dtype(collection):
+    """ Returns the numpy dtype of a row of 'collection': the document's _id
+    (as a hex string), its 'doc_version', its flags and its columns. """
+
+    fields = [("_id", "S24"), ("doc_version", "i8")]
+    fields.extend([(flag, "i1") for flag in flag_attribs[collection]])
+    for attrib in column_attribs[collection]:
+        fields.extend([(attrib, "f8"), ("%s_kind" % attrib, "i1")])
+    return numpy.dtype(fields)
+
+
+#
+#   The column store
+#
+
+class columnStore:
+    """ A NumPy snapshot of the numeric attribs of every document in a
+    collection, stored on disk (in the 'columns_dir' directory) as a single
+    .npy file of rows and memory-mapped when we read it. Index it like a dict
+    to get a column, e.g. columnStore("survivors")["hunt_xp"].
+
+    refresh() brings the snapshot up to date incrementally: only documents
+    that are new, or whose 'doc_version' has moved, get read from mdb. The
+    snapshot is rebuilt from scratch every 'columns_rebuild_age' minutes, to
+    pick up anything that changed without a 'doc_version' bump. """
+
+    def __init__(self, collection):
+        if numpy is None:
+            raise Exception("The column store requires NumPy!")
+        if collection not in column_attribs.keys():
+            raise Exception("Unsupported collection type! '%s' has no columns!" % collection)
+
+        self.logger = get_logger()
+        self.collection = collection
+        self.dtype = get_dtype(collection)
+        columns_dir = os.path.abspath(settings.get("application","columns_dir"))
+        try:
+            os.mkdir(columns_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:    # the other collection's refresh beat us to it
+                raise
+        self.path = os.path.join(columns_dir, "%s.npy" % collection)
+        self.rebuilt_path = self.path + ".rebuilt"     # its mtime is our last rebuild
+        self.rows = None
+        self.load()
+
+
+    def __getitem__(self, attrib):
+        return self.rows[attrib]
+
+
+    def __len__(self):
+        if self.rows is None:
+            return 0
+        return len(self.rows)
+
+
+    def get_age(self):
+        """ Returns the number of (whole) minutes since the snapshot was last
+        rebuilt from scratch or None if it never has been. """
+        if not os.path.isfile(self.path) or not os.path.isfile(self.rebuilt_path):
+            return None
+        return int((datetime.now() - datetime.fromtimestamp(os.path.getmtime(self.rebuilt_path))).total_seconds() // 60)
+
+
+    def load(self):
+        """ Memory-maps the snapshot file. If the file is missing or it was
+        written with different columns, we start with no rows. """
+
+        self.rows = numpy.zeros(0, dtype=self.dtype)
+        if not os.path.isfile(self.path):
+            return False
+        rows = numpy.load(self.path, mmap_mode="r")
+        if rows.dtype != self.dtype:
+            self.logger.warn("Column snapshot '%s' has out of date columns. Ignoring it." % self.path)
+            return False
+        self.rows = rows
+        return True
+
+
+    def get_rows(self, documents):
+        """ Turns an iterable of documents into an array of rows. """
+        rows = []
+        for d in documents:
+            row = [str(d["_id"]), d.get("doc_version", 0)]
+            row.extend([int(flag in d.keys()) for flag in flag_attribs[self.collection]])
+            for attrib in column_attribs[self.collection]:
+                row.extend(get_column_value(d, attrib))
+            rows.append(tuple(row))
+        return numpy.array(rows, dtype=self.dtype)
+
+
+    def refresh(self, rebuild=False):
+        """ Brings the snapshot up to date with mdb and writes it to disk. Use
+        'rebuild' to read every document instead of just the ones that have
+        changed. Returns the number of rows that were (re)read. """
+
+        start = datetime.now()
+        rebuild_age = settings.getint("application","columns_rebuild_age")
+        age = self.get_age()
+        if age is None or age > rebuild_age:
+            rebuild = True
+
+        projection = dict([(a, True) for a in ["doc_version"] + flag_attribs[self.collection] + column_attribs[self.collection]])
+
+        if rebuild:
+            rows = self.get_rows(mdb[self.collection].find({}, projection))
+            changed = len(rows)
+        else:
+            # compare versions: the projection only has _id and doc_version
+            versions = {}
+            for d in mdb[self.collection].find({}, {"doc_version": True}):
+                versions[str(d["_id"])] = d.get("doc_version", 0)
+
+            keep = numpy.array([versions.get(r_id, -1) == r_version for r_id, r_version in zip(self.rows["_id"], self.rows["doc_version"])], dtype=bool)
+            kept_ids = set(self.rows["_id"][keep])
+            stale_ids = [d_id for d_id in versions.keys() if d_id not in kept_ids]
+            if stale_ids == [] and keep.all():
+                return 0
+
+            new_rows = []
+            for i in range(0, len(stale_ids), 1000):
+                batch = [ObjectId(d_id) for d_id in stale_ids[i:i + 1000]]
+                new_rows.append(self.get_rows(mdb[self.collection].find({"_id": {"$in": batch}}, projection)))
+            rows = numpy.concatenate([numpy.array(self.rows[keep])] + new_rows)
+            changed = len(stale_ids)
+
+        self.write(rows)
+        if rebuild:
+            file(self.rebuilt_path, "w").close()
+        self.load()
+        self.logger.debug("Refreshed %s column snapshot: %s rows (re)read, %s rows total, %s seconds." % (self.collection, changed, len(self.rows), (datetime.now() - start).total_seconds()))
+        return changed
+
+
+    def write(self, rows):
+        """ Writes 'rows' to a temp file and renames it into place, so that
+        anybody who has the old file mapped keeps reading the old file. """
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".%s." % self.collection)
+        out_file_handle = os.fdopen(fd, "wb")
+        try:
+            numpy.save(out_file_handle, rows)
+            out_file_handle.flush()
+            os.fsync(out_file_handle.fileno())
+            out_file_handle.close()
+            os.rename(temp_path, self.path)
+        except:
+            out_file_handle.close()
+            os.remove(temp_path)
+            raise
+
+
+
+#
+#   Samples and statistics
+#
+
+def get_sample(store, sample):
+    """ Returns a boolean mask of the rows in 'store' that are in 'sample'.
+    These mirror world.minmax_query and world.average_queries: a $gt in a
+    query only matches numbers (not numeric strings, bools, etc.), so only
+    KIND_NUMBER values get compared. """
+
+    def gt(attrib, value):
+        return (store["%s_kind" % attrib] == KIND_NUMBER) & (store[attrib] > value)
+
+    with numpy.errstate(invalid="ignore"):
+        if sample == "minmax":
+            return gt("population", 4) & gt("death_count", 0)
+        elif sample == "settlements":
+            return (gt("population", 4) | gt("lantern_year", 2)) & gt("death_count", 0)
+        elif sample == "survivors":
+            return store["dead"] == 0
+    return numpy.ones(len(store), dtype=bool)
+
+
+def get_values(store, attrib, sample=None, return_type=float):
+    """ Returns the converted values of 'attrib' for the rows in 'sample'.
+    Like world.attrib_as_number(), int values can't come from strings like
+    "3.5" (that's a $convert error, i.e. null) and get truncated later. """
+    mask = store["%s_kind" % attrib] != KIND_NONE
+    if return_type == int:
+        mask &= store["%s_kind" % attrib] != KIND_FLOAT_STRING
+    if sample is not None:
+        mask &= get_sample(store, sample)
+    return store[attrib][mask]
+
+
+def get_average(store, attrib, sample=None, precision=2, return_type=int):
+    """ Works like world.get_average(): int averages truncate each value and
+    the result, float averages get rounded to 'precision'. """
+
+    values = get_values(store, attrib, sample, return_type)
+    if len(values) == 0:
+        return 0
+    if return_type == int:
+        return int(numpy.trunc(values).sum()) // len(values)
+    return round(float(values.sum()) / len(values), precision)
+
+
+def get_minmax(store, attrib, sample="minmax"):
+    """ Returns the lowest and highest values of 'attrib' as ints. """
+    values = get_values(store, attrib, sample, int)
+    if len(values) == 0:
+        return None, None
+    return int(values.min()), int(values.max())
+
+
+def get_percentiles(store, attrib, percentiles=[25, 50, 75, 90, 99], sample=None):
+    """ Returns a dict of percentile to value. """
+    values = get_values(store, attrib, sample)
+    if len(values) == 0:
+        return {}
+    return dict(zip(percentiles, [float(p) for p in numpy.percentile(values, percentiles)]))
+
+
+def get_histogram(store, attrib, bins=10, sample=None):
+    """ Returns a list of (bin start, bin end, count) tuples. """
+    values = get_values(store, attrib, sample)
+    if len(values) == 0:
+        return []
+    counts, edges = numpy.histogram(values, bins=bins)
+    return [(float(edges[i]), float(edges[i + 1]), int(counts[i])) for i in range(len(counts))]
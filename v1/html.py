@@ -1920,9 +1920,12 @@ def authenticate_by_form(params):
                 if "preferences" not in s.User.user:
                     s.User.user["preferences"] = {}
                 s.User.user["preferences"]["preserve_sessions"] = True
-                mdb.users.save(s.User.user)
+                mdb.users.update_one({"_id": s.User.user["_id"]}, {"$set": {"preferences.preserve_sessions": True}})
+                mdb.sessions.update_one({"_id": session_id}, {"$set": {"expires_at": admin.get_session_expiration(s.User, s.session["created_on"])}})
 
             html, body = s.current_view_html()
+            s.event_buffer.flush()
+            s.User.flush_usage()
             render(html, body_class=body, head=[set_cookie_js(session_id)])
     else:
         output = login.form
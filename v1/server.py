@@ -4,6 +4,8 @@
 import CGIHTTPServer
 import BaseHTTPServer
 import daemon
+import errno
+import fcntl
 import logging
 from lockfile.pidlockfile import PIDLockFile
 from optparse import OptionParser
@@ -11,12 +13,19 @@ import os
 from pwd import getpwuid
 import shutil
 import psutil
+import Queue
+import signal
 import SimpleHTTPServer
+import socket
 import SocketServer
 import subprocess
 import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 
 #   custom imports
+import utils
 from utils import get_logger, load_settings
 
 class StreamToLogger(object):
@@ -31,9 +40,80 @@ class StreamToLogger(object):
          logger.log(logger.level, line.rstrip())
 
 
-class ThreadingSimpleServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
-    """ Initializes a vanilla server with threading by subclassing the above and
-    overwriting literally nothing. """
+class boundedThreadPoolMixIn:
+    """ Use this instead of SocketServer.ThreadingMixIn to handle requests with
+    a fixed number of worker threads. Accepted connections wait in a bounded
+    queue; when the queue is full, we fail fast with a 503 (and a Retry-After
+    header) instead of piling up threads and CGI processes.
+
+    Call start_pool() before serve_forever(). Queue-wait times are tracked in
+    self.pool_stats and summarized in the log every 'stats_interval' requests.
+    """
+
+    stats_interval = 100
+
+    def start_pool(self, threads, queue_depth, retry_after):
+        self.retry_after = retry_after
+        self.request_queue = Queue.Queue(maxsize=queue_depth)
+        self.pool_stats = {"handled": 0, "rejected": 0, "total_wait": 0.0, "max_wait": 0.0}
+        self.pool_stats_lock = threading.Lock()
+        for i in range(threads):
+            t = threading.Thread(target=self.pool_worker, name="request_worker_%s" % i)
+            t.daemon = True
+            t.start()
+        logger.info("Started %s request threads (queue depth: %s)." % (threads, queue_depth))
+
+
+    def process_request(self, request, client_address):
+        """ Called by the listening thread: queue the request or reject it. """
+        try:
+            self.request_queue.put_nowait((request, client_address, time.time()))
+        except Queue.Full:
+            self.reject_request(request, client_address)
+
+
+    def reject_request(self, request, client_address):
+        """ Sends a bare-bones 503 and closes the connection. """
+        with self.pool_stats_lock:
+            self.pool_stats["rejected"] += 1
+            rejected = self.pool_stats["rejected"]
+        logger.warn("Request queue is full! Rejected request from %s (%s rejected so far)." % (client_address[0], rejected))
+        body = "<h1>503 - Service Unavailable</h1><p>The Manager is very busy right now. Please try again in a few seconds.</p>"
+        response = "HTTP/1.0 503 Service Unavailable\r\nRetry-After: %s\r\nContent-Type: text/html\r\nContent-Length: %s\r\n\r\n%s" % (self.retry_after, len(body), body)
+        try:
+            request.sendall(response)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+
+    def pool_worker(self):
+        """ Worker thread loop. This is basically ThreadingMixIn's
+        process_request_thread(), with queue-wait bookkeeping. """
+        while True:
+            request, client_address, queued_at = self.request_queue.get()
+            self.record_wait(time.time() - queued_at)
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+    def record_wait(self, wait):
+        with self.pool_stats_lock:
+            stats = self.pool_stats
+            stats["handled"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            if stats["handled"] % self.stats_interval == 0:
+                logger.info("Request pool: %s handled, %s rejected; queue wait avg %.3fs, max %.3fs; %s queued." % (stats["handled"], stats["rejected"], stats["total_wait"] / stats["handled"], stats["max_wait"], self.request_queue.qsize()))
+
+
+class ThreadingSimpleServer(boundedThreadPoolMixIn,BaseHTTPServer.HTTPServer):
+    """ Initializes a vanilla server with a bounded pool of request threads by
+    subclassing the above and overwriting literally nothing. """
 
     pass
 
@@ -48,9 +128,174 @@ class customRequestHandler(CGIHTTPServer.CGIHTTPRequestHandler):
         logger.log(logger.level, "%s" % (format%args))
 
 
-def start_server(port=None):
+class customWSGIRequestHandler(WSGIRequestHandler):
+    """ Request handler for the in-process application server. Like the CGI
+    handler above, this just sends its log messages to our logger. """
+
+    def log_message(self, format, *args):
+        logger.log(logger.level, "%s" % (format%args))
+
+
+class preforkServer:
+    """ Runs a fixed-size pool of worker processes that all accept connections
+    from the same listening socket. The application modules (including the
+    game catalog and the models) are imported by the master before it forks,
+    so the workers share those pages copy-on-write instead of each loading
+    their own copies.
+
+    Signals handled by the master:
+
+        SIGHUP:             gracefully stop the workers (i.e. let them finish
+                            whatever request they're working on) and re-exec
+                            the master, which reloads the application code and
+                            starts a new pool on the same socket.
+        SIGTERM/SIGINT:     gracefully stop the workers and return.
+
+    Workers that die for any other reason are replaced automatically.
+    """
+
+    def __init__(self, server, workers):
+        self.server = server
+        self.worker_count = workers
+        self.workers = set()
+        self.reload_requested = False
+        self.stop_requested = False
+
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+
+
+    def spawn_worker(self):
+        """ Forks a worker. The child never returns from this method. """
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker()
+        self.workers.add(pid)
+        logger.debug("Started worker process %s." % pid)
+
+
+    def run_worker(self):
+        """ The worker's main loop: handle one request at a time until the
+        master asks us to stop. The listening socket is non-blocking, so when
+        another worker wins the race for a connection, handle_request() just
+        returns and we go back to waiting. """
+
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.request_stop)
+
+        # don't share the master's Mongo sockets
+        utils.mdb_manager.after_fork()
+
+        exit_status = 0
+        try:
+            self.server.timeout = 1
+            while not self.stop_requested:
+                self.server.handle_request()
+        except Exception as e:
+            logger.error("Worker process %s crashed!" % os.getpid())
+            logger.exception(e)
+            exit_status = 1
+        os._exit(exit_status)
+
+
+    def stop_workers(self):
+        """ Asks every worker to stop and waits for them to finish. """
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while self.workers != set():
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self.workers.discard(pid)
+        self.workers = set()
+        logger.info("All worker processes stopped.")
+
+
+    def reexec(self):
+        """ Replaces the master process with a fresh copy of itself. The PID
+        stays the same (so the PID file is still good) and the listening socket
+        is handed down, so no connections are refused while we reload. """
+
+        listen_fd = self.server.socket.fileno()
+        flags = fcntl.fcntl(listen_fd, fcntl.F_GETFD)
+        fcntl.fcntl(listen_fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        os.environ["KDM_MANAGER_LISTEN_FD"] = str(listen_fd)
+        logger.warn("Reloading server (PID %s)..." % os.getpid())
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+    def serve_forever(self):
+        """ Starts the pool and supervises it until we're asked to stop. """
+
+        self.server.socket.setblocking(0)
+
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        logger.info("Starting %s worker processes..." % self.worker_count)
+        for i in range(self.worker_count):
+            self.spawn_worker()
+
+        while not (self.stop_requested or self.reload_requested):
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not (self.stop_requested or self.reload_requested):
+                    logger.error("Worker process %s exited unexpectedly (status %s)! Replacing it..." % (pid, status))
+                    self.spawn_worker()
+
+        self.stop_workers()
+        if self.reload_requested:
+            self.reexec()
+
+
+def get_application_server(server_port):
+    """ Returns a WSGIServer for the application. If we've been re-executed by
+    a preforkServer, we pick up the listening socket we inherited instead of
+    binding a new one. """
+
+    inherited_fd = os.environ.pop("KDM_MANAGER_LISTEN_FD", None)
+    if inherited_fd is None:
+        return WSGIServer(('', server_port), customWSGIRequestHandler)
+
+    logger.info("Using inherited listening socket (fd %s)." % inherited_fd)
+    server = WSGIServer(('', server_port), customWSGIRequestHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = socket.fromfd(int(inherited_fd), socket.AF_INET, socket.SOCK_STREAM)
+    os.close(int(inherited_fd))     # fromfd() dup's the fd, so close the original
+    server.server_address = server.socket.getsockname()
+    server.server_name = socket.getfqdn(server.server_address[0])
+    server.server_port = server.server_address[1]
+    server.setup_environ()
+    return server
+
+
+def start_server(port=None, mode=None):
     """ Starts a server. If you do this outside of a forked/daemonized process,
-    you can watch it and manually Ctrl-C it. """
+    you can watch it and manually Ctrl-C it.
+
+    The 'mode' kwarg is either 'application' (the default), which serves
+    requests in-process using application.py, or 'cgi', which forks a new
+    interpreter for every request. Leave it as None to use the 'mode' setting
+    from settings.cfg. """
 
     if os.getuid() == 0:
         logger.error("The server cannot be started as root.")
@@ -65,10 +310,10 @@ def start_server(port=None):
 
     logger.info("Server will listen on port %s..." % server_port)
 
+    if mode is None:
+        mode = settings.get("server","mode")
+
     try:
-        handler = customRequestHandler  # see above
-        handler.cgi_directories.extend(["/"])
-        server = ThreadingSimpleServer(('', server_port), handler)
         u_name = getpwuid(os.getuid())[0]
         effective_home_dir = "/home/%s/" % u_name
         app_cwd = os.path.join(effective_home_dir, "kdm-manager/v1")
@@ -78,6 +323,28 @@ def start_server(port=None):
         logger.error("Could not set application CWD!")
         logger.exception(e)
 
+    if mode == "application":
+        logger.info("Loading application modules...")
+        import application
+        server = get_application_server(server_port)
+        server.set_app(application.application)
+        workers = settings.getint("server","workers")
+        if workers > 0:
+            preforkServer(server, workers).serve_forever()
+            server.server_close()
+            logger.critical("Server stopped. Exiting.")
+            return
+    else:
+        logger.info("Starting server in CGI mode...")
+        handler = customRequestHandler  # see above
+        handler.cgi_directories.extend(["/"])
+        server = ThreadingSimpleServer(('', server_port), handler)
+        server.start_pool(
+            settings.getint("server","threads"),
+            settings.getint("server","queue_depth"),
+            settings.getint("server","retry_after"),
+        )
+
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -86,7 +353,7 @@ def start_server(port=None):
         sys.exit()
 
 
-def start_daemon():
+def start_daemon(mode=None):
     """ Uses DaemonContext to fork (i.e. daemonize) the start_server()
     function which, obviously, makes the server immune to Ctrl-C.
 
@@ -103,7 +370,14 @@ def start_daemon():
 
     with context:
         logger.info("PID file location is '%s'" % settings.get("server", "pid_file"))
-        start_server()
+        start_server(mode=mode)
+
+
+def reload_daemon():
+    """ Sends SIGHUP to the daemon, which gracefully restarts its workers. """
+    pid = get_pid()
+    logger.warn("Sending SIGHUP to PID %s" % pid)
+    os.kill(pid, signal.SIGHUP)
 
 
 def stop_daemon():
@@ -150,14 +424,33 @@ if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-i", dest="interactive", help="Run the server in 'interactive' mode (print output to STDOUT)", default=False, action="store_true")
     parser.add_option("-p", dest="port", help="Force the server to run on the specified port", default=None, metavar="9999")
+    parser.add_option("-r", dest="reload", help="Gracefully restart the server's worker processes (and reload the application code)", default=False, action="store_true")
+    parser.add_option("-c", dest="cgi", help="Fork a CGI process for every request instead of serving requests in-process", default=False, action="store_true")
     (options, args) = parser.parse_args()
 
+    mode = None
+    if options.cgi:
+        mode = "cgi"
+
+    if options.reload:
+        reload_daemon()
+        sys.exit()
+
+    # if a preforkServer re-exec'd us, we're already daemonized: just serve and
+    #   clean up the PID file that the DaemonContext would have released
+    if "KDM_MANAGER_LISTEN_FD" in os.environ:
+        start_server(options.port, mode)
+        if get_pid() == os.getpid():
+            os.remove(settings.get("server","pid_file"))
+        sys.exit()
+
     if options.interactive:
         logger.info("Starting server in interactive mode!")
-        start_server(options.port)
+        start_server(options.port, mode)
+        sys.exit()
 
     if not os.path.isfile(settings.get("server","pid_file")):
-        start_daemon()
+        start_daemon(mode)
     else:
         logger.info("PID found. Attempting to stop server...")
         pid = get_pid()
@@ -166,4 +459,4 @@ if __name__ == "__main__":
         else:
             logger.warn("pid file '%s' exists, but PID '%s' does not!" % (settings.server_pidfile, pid))
             shutil.os.remove(settings.server_pidfile)
-            start_daemon()
+            start_daemon(mode)
@@ -2,11 +2,14 @@
 
 from bson.objectid import ObjectId
 import Cookie
+from copy import deepcopy
 from datetime import datetime
 import os
+from pymongo.errors import BulkWriteError
 import random
 import string
 import sys
+import time
 import traceback
 
 import admin
@@ -18,6 +21,225 @@ from utils import mdb, get_logger, get_user_agent, load_settings, ymd, ymdhms, m
 
 settings = load_settings()
 
+class identityMap:
+    """ Request-scoped unit of work for settlement and survivor documents.
+
+    Every assets.Settlement and assets.Survivor initialized with a Session
+    object gets its document from here, so each document is loaded (and
+    normalized) at most once per request, and every object that refers to the
+    same settlement or survivor shares the same dict.
+
+    The map also keeps a copy of each document as it was when it was loaded
+    (or last saved), so that save() can write only what changed, and uses the
+    'doc_version' attrib of the document to make sure nobody else has changed
+    it in the meantime. """
+
+    def __init__(self):
+        self.logger = get_logger()
+        self.documents = {"settlements": {}, "survivors": {}}
+        self.snapshots = {"settlements": {}, "survivors": {}}
+        self.normalized = {"settlements": set(), "survivors": set()}
+        self.family_graphs = {}     # settlement _id -> assets.familyGraph
+
+    def load(self, collection, asset_id):
+        """ Returns the document with the _id 'asset_id' from 'collection',
+        going to mdb for it only if we haven't seen it yet this request. """
+
+        asset_id = ObjectId(asset_id)
+        if asset_id not in self.documents[collection]:
+            document = mdb[collection].find_one({"_id": asset_id})
+            if document is None:
+                return None
+            self.documents[collection][asset_id] = document
+            self.snapshots[collection][asset_id] = deepcopy(document)
+        return self.documents[collection][asset_id]
+
+    def get_changes(self, snapshot, document):
+        """ Diffs 'document' against 'snapshot' and returns a mdb update dict.
+        Lists that have only been appended to get a $push; everything else that
+        changed gets a $set or an $unset. Returns an empty dict if nothing
+        changed. """
+
+        set_attribs = {}
+        unset_attribs = {}
+        push_attribs = {}
+        for k, v in document.iteritems():
+            if k in ["_id", "doc_version"]:
+                continue
+            if k not in snapshot.keys():
+                set_attribs[k] = v
+            elif snapshot[k] != v:
+                old = snapshot[k]
+                if type(old) == list and type(v) == list and len(v) > len(old) and v[:len(old)] == old:
+                    push_attribs[k] = {"$each": v[len(old):]}
+                else:
+                    set_attribs[k] = v
+        for k in snapshot.keys():
+            if k not in document.keys():
+                unset_attribs[k] = ""
+
+        changes = {}
+        for operator, attribs in [("$set", set_attribs), ("$unset", unset_attribs), ("$push", push_attribs)]:
+            if attribs != {}:
+                changes[operator] = attribs
+        return changes
+
+    def save(self, collection, document):
+        """ Writes 'document' to 'collection'. If it's one of ours, this is a
+        single update_one() of the attribs that changed since we loaded it,
+        conditional on its 'doc_version' not having moved. Anything else gets a
+        regular save() (which still bumps its 'doc_version'). """
+
+        asset_id = document["_id"]
+        if collection == "survivors" and "settlement" in document.keys():
+            self.forget_family_graph(document["settlement"])
+        if self.documents[collection].get(asset_id) is not document:
+            document["doc_version"] = document.get("doc_version", 0) + 1
+            mdb[collection].save(document)
+            return
+
+        snapshot = self.snapshots[collection][asset_id]
+        changes = self.get_changes(snapshot, document)
+        if changes == {}:
+            return
+
+        current_version = snapshot.get("doc_version", 0)
+        changes["$inc"] = {"doc_version": 1}
+        if current_version == 0:
+            version_query = {"$exists": False}
+        else:
+            version_query = current_version
+        result = mdb[collection].update_one({"_id": asset_id, "doc_version": version_query}, changes)
+
+        if result.matched_count == 0:
+            if not self.merge(collection, document, changes):
+                return  # keep the old snapshot, so the next save() tries again
+        else:
+            document["doc_version"] = current_version + 1
+
+        self.snapshots[collection][asset_id] = deepcopy(document)
+
+    def merge(self, collection, document, changes, retries=5):
+        """ Somebody else saved the document after we loaded it. Re-read it
+        and retry our changes as a compare-and-set against the 'doc_version'
+        we just read, until it sticks (or we've tried 'retries' times). Then
+        pick up whatever they changed that we didn't.
+
+        This is last-writer-wins per attrib: for attribs that both of us
+        changed, ours win (and we log a warning). $push'd lists keep both.
+        Returns False if we couldn't save. """
+
+        asset_id = document["_id"]
+        snapshot = self.snapshots[collection][asset_id]
+
+        our_attribs = set()
+        for operator in ["$set", "$unset", "$push"]:
+            our_attribs.update(changes.get(operator, {}).keys())
+
+        for attempt in range(retries):
+            current = mdb[collection].find_one({"_id": asset_id})
+            if current is None:
+                self.logger.error("Could not save %s %s: it has been removed!" % (collection, asset_id))
+                return False
+
+            current_version = current.get("doc_version", 0)
+            if current_version == 0:
+                version_query = {"$exists": False}
+            else:
+                version_query = current_version
+            result = mdb[collection].update_one({"_id": asset_id, "doc_version": version_query}, changes)
+            if result.matched_count == 0:
+                continue
+
+            for k in our_attribs:
+                if k not in changes.get("$push", {}) and current.get(k) != snapshot.get(k):
+                    self.logger.warn("Concurrent update of '%s' on %s %s! Keeping our value." % (k, collection, asset_id))
+            for k in current.keys():
+                if k not in our_attribs and current[k] != snapshot.get(k):
+                    document[k] = current[k]
+            for k in snapshot.keys():
+                if k not in our_attribs and k not in current.keys():
+                    document.pop(k, None)
+            for k in changes.get("$push", {}).keys():
+                document[k] = current.get(k, []) + changes["$push"][k]["$each"]
+            document["doc_version"] = current_version + 1
+            return True
+
+        self.logger.error("Could not save %s %s: it kept changing under us (%s tries)!" % (collection, asset_id, retries))
+        return False
+
+    def is_normalized(self, collection, asset_id):
+        return ObjectId(asset_id) in self.normalized[collection]
+
+    def mark_normalized(self, collection, asset_id):
+        self.normalized[collection].add(ObjectId(asset_id))
+
+    def get_family_graph(self, settlement_id):
+        return self.family_graphs.get(ObjectId(settlement_id), None)
+
+    def set_family_graph(self, settlement_id, family_graph):
+        self.family_graphs[ObjectId(settlement_id)] = family_graph
+
+    def forget_family_graph(self, settlement_id):
+        """ Call this when one of the settlement's survivors is created, saved
+        or removed. save() and evict() do it for you. """
+        self.family_graphs.pop(ObjectId(settlement_id), None)
+
+    def evict(self, collection, asset_id):
+        """ Call this when a document is removed from mdb. """
+        asset_id = ObjectId(asset_id)
+        document = self.documents[collection].get(asset_id, None)
+        if collection == "survivors" and document is not None and "settlement" in document.keys():
+            self.forget_family_graph(document["settlement"])
+        self.documents[collection].pop(asset_id, None)
+        self.snapshots[collection].pop(asset_id, None)
+        self.normalized[collection].discard(asset_id)
+
+
+class eventBuffer:
+    """ Collects the settlement events logged during a request so that they
+    can be written to mdb.settlement_events all at once. Make sure flush() gets
+    called when the request is finished (or blows up), or before reading the
+    settlement_events collection. """
+
+    def __init__(self):
+        self.logger = get_logger()
+        self.events = []
+
+    def append(self, event):
+        self.events.append(event)
+
+    def flush(self, retries=3):
+        """ Writes all buffered events with a single insert_many(). The buffer
+        only lives as long as the request, so if the write fails, we retry it
+        right here ('retries' times, backing off a little in between). Events
+        that already made it in on an earlier try are duplicate keys, which is
+        fine. If we still can't write them, they get dumped to the log, so
+        they can be recovered from there. """
+
+        if self.events == []:
+            return True
+        events = self.events
+        self.events = []
+
+        for attempt in range(retries):
+            try:
+                mdb.settlement_events.insert_many(events, ordered=False)
+                return True
+            except BulkWriteError as e:
+                if all([err.get("code") == 11000 for err in e.details.get("writeErrors", [])]) and e.details.get("writeConcernErrors", []) == []:
+                    return True
+                self.logger.exception(e)
+            except Exception as e:
+                self.logger.exception(e)
+            time.sleep(0.1 * 2 ** attempt)
+
+        self.logger.error("Could not write %s buffered settlement events after %s tries! Dumping them here:" % (len(events), retries))
+        for event in events:
+            self.logger.error("Lost settlement event: %s" % event)
+        return False
+
+
 class Session:
     """ The properties of a Session object are these:
 
@@ -35,16 +257,30 @@ class Session:
         # these are our session attributes. Declare them all here
         self.params = params
         self.session = None
+        self.session_snapshot = {}
         self.Settlement = None
         self.User = None
+        self.identity_map = identityMap()
+        self.event_buffer = eventBuffer()
+
+        try:
+            self.load_session()
+        except:
+            self.event_buffer.flush()
+            raise
+
+
+    def load_session(self):
+        """ Called by __init__(). Handles sign-outs and then retrieves the mdb
+        session, the User and the current Settlement. """
 
         # we're not processing params yet, but if we have a log out request, we
         #   do it here, while we're initializing a new session object.
         if "remove_session" in self.params:
             user = mdb.users.find_one({"current_session": ObjectId(self.params["remove_session"].value)})
             if user is not None:
-                self.User = assets.User(user_id=user["_id"], session_object={"_id": 0})
-                self.User.mark_usage("signed out")
+                self.User = assets.User(user["_id"], session_object={"_id": 0}, user_document=user)
+                self.User.mark_usage("signed out")     # not a real Session, so this writes right away
             admin.remove_session(self.params["remove_session"].value, self.params["login"].value)
 
         # try to retrieve a session and other session attributes from mdb using
@@ -53,13 +289,59 @@ class Session:
 
         if self.cookie is not None and "session" in self.cookie.keys():
             session_id = ObjectId(self.cookie["session"].value)
-            self.session = mdb.sessions.find_one({"_id": session_id})
-            if self.session is not None:
-                user_object = mdb.users.find_one({"current_session": session_id})
-                self.User = assets.User(user_object["_id"], session_object=self)
+            session, user = self.resolve_session(session_id)
+            if session is not None and session.get("expires_at", None) is not None and session["expires_at"] < datetime.utcnow():
+                session = None  # expired, but the TTL monitor hasn't gotten to it yet
+            if session is not None:
+                self.session = session
+                self.session_snapshot = deepcopy(session)
+                self.User = assets.User(user["_id"], session_object=self, user_document=user)
                 self.set_current_settlement()
 
 
+    def resolve_session(self, session_id):
+        """ Returns the session document and the user document for a session
+        _id, or (None, None) if the session doesn't exist or isn't its user's
+        current session.
+
+        One aggregation gets both the session and its user (by login, which is
+        indexed). """
+
+        results = list(mdb.sessions.aggregate([
+            {"$match": {"_id": session_id}},
+            {"$lookup": {"from": "users", "localField": "login", "foreignField": "login", "as": "users"}},
+        ]))
+        if results == []:
+            return None, None
+
+        session = results[0]
+        users = [u for u in session.pop("users") if u.get("current_session", None) == session_id]
+        if users == []:
+            return None, None
+
+        return session, users[0]
+
+
+    def write_session(self):
+        """ Writes the session's view attribs to mdb, if (and only if) they've
+        changed since we loaded the session (or last wrote it). Returns True
+        if we wrote something. """
+
+        if self.session is None:
+            return False
+
+        changes = {}
+        for k in ["current_view", "current_settlement", "current_asset"]:
+            if k in self.session.keys() and (k not in self.session_snapshot.keys() or self.session[k] != self.session_snapshot[k]):
+                changes[k] = self.session[k]
+        if changes == {}:
+            return False
+
+        mdb.sessions.update_one({"_id": self.session["_id"]}, {"$set": changes})
+        self.session_snapshot = deepcopy(self.session)
+        return True
+
+
     def new(self, login):
         """ Creates a new session. Only needs a valid user login.
 
@@ -69,21 +351,25 @@ class Session:
         user = mdb.users.find_one({"login": login})
         mdb.sessions.remove({"login": user["login"]})
 
+        self.User = assets.User(user["_id"], session_object=self, user_document=user)
+
+        created_on = datetime.now()
+        user_agent = get_user_agent()
         session_dict = {
             "login": login,
-            "created_on": datetime.now(),
+            "created_on": created_on,
+            "expires_at": admin.get_session_expiration(self.User, created_on),
             "current_view": "dashboard",
-            "user_agent": {"is_mobile": get_user_agent().is_mobile, "browser": get_user_agent().browser },
+            "user_agent": {"is_mobile": user_agent.is_mobile, "browser": user_agent.browser, "repr": str(user_agent)},
         }
         session_id = mdb.sessions.insert(session_dict)
-        self.session = mdb.sessions.find_one({"_id": ObjectId(session_id)})
+        self.session = session_dict
+        self.session_snapshot = deepcopy(session_dict)
 
         # update the user with the session ID
         user["current_session"] = session_id
         mdb.users.save(user)
 
-        self.User = assets.User(user["_id"], session_object=self)
-
         return session_id   # passes this back to the html.create_cookie_js()
 
 
@@ -171,7 +457,7 @@ class Session:
 
 #        if self.Settlement is None:
 #            self.logger.debug("Unable to set 'current_settlement' for session '%s'." % self.session["_id"])
-        mdb.sessions.save(self.session)
+        self.write_session()
 
 
 
@@ -198,8 +484,7 @@ class Session:
                 self.session["current_settlement"] = asset
                 self.set_current_settlement(settlement_id = asset)
 
-        mdb.sessions.save(self.session)
-        self.session = mdb.sessions.find_one(self.session["_id"])
+        self.write_session()
 
 
     def process_params(self, user_action=None):
@@ -277,7 +562,7 @@ class Session:
                 self.change_current_view("view_campaign", asset_id=self.Settlement.settlement["_id"])
                 if "create_prologue_survivors" in self.params:
                     self.Settlement.first_story()
-                    mdb.settlements.save(self.Settlement.settlement)    # gotta save here
+                    self.Settlement.save()    # gotta save here
                     user_action = "created settlement %s with First Story survivors" % self.Settlement
                 else:
                     user_action = "created vanilla settlement %s" % self.Settlement
@@ -293,7 +578,7 @@ class Session:
                 # initialize expansion stuff
                 for e_key in expansions:
                     self.Settlement.add_expansion(e_key)
-                mdb.settlements.save(self.Settlement.settlement)
+                self.Settlement.save()
 
             if self.params["new"].value == "survivor":
                 S = assets.Survivor(params=self.params, session_object=self)
@@ -417,6 +702,7 @@ class Session:
                 output += S.render_html_event_log()
             elif self.session["current_view"] == "view_campaign":
                 output += html.dashboard.refresh_button
+                self.event_buffer.flush()
                 if mdb.settlement_events.find({"settlement_id": self.Settlement.settlement["_id"]}).count() != 0:
                     output += html.dashboard.event_log_button.safe_substitute(name=self.Settlement.settlement["name"])
                 if self.Settlement.settlement is not None and self.Settlement.settlement["created_by"] == self.User.user["_id"]:
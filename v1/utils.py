@@ -11,9 +11,10 @@ from email.mime.text import MIMEText
 import json
 import logging
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 import smtplib
 import sys
+import threading
 import time
 from urllib import urlopen
 from user_agents import parse as ua_parse
@@ -43,7 +44,154 @@ def load_settings(settings_type=None):
 #
 
 settings = load_settings()
-mdb = MongoClient()[settings.get("application","mdb")]
+
+
+#
+#   MongoDB connection management
+#
+
+#   pool monitoring requires pymongo 3.9+; without it, we still pool, we just
+#   can't count things
+if hasattr(monitoring, "ConnectionPoolListener"):
+    PoolListenerBase = monitoring.ConnectionPoolListener
+else:
+    PoolListenerBase = object
+
+
+class poolStatsListener(PoolListenerBase):
+    """ Connection pool event listener that keeps running totals for the pool:
+    how many connections are checked out, how many have been created/closed
+    and how long threads have had to wait to check one out. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkout_started = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checkout_started.clear()
+            self.stats = {
+                "created": 0,
+                "closed": 0,
+                "in_use": 0,
+                "checkouts": 0,
+                "checkout_failures": 0,
+                "checkout_wait_total": 0.0,
+                "checkout_wait_max": 0.0,
+            }
+
+    def connection_check_out_started(self, event):
+        self.checkout_started[threading.current_thread().ident] = time.time()
+
+    def connection_checked_out(self, event):
+        started = self.checkout_started.pop(threading.current_thread().ident, None)
+        with self.lock:
+            self.stats["in_use"] += 1
+            self.stats["checkouts"] += 1
+            if started is not None:
+                wait = time.time() - started
+                self.stats["checkout_wait_total"] += wait
+                self.stats["checkout_wait_max"] = max(self.stats["checkout_wait_max"], wait)
+
+    def connection_check_out_failed(self, event):
+        self.checkout_started.pop(threading.current_thread().ident, None)
+        with self.lock:
+            self.stats["checkout_failures"] += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.stats["in_use"] = max(0, self.stats["in_use"] - 1)
+
+    def connection_created(self, event):
+        with self.lock:
+            self.stats["created"] += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.stats["closed"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+#   see connectionManager.check_server_version()
+min_server_version = (4, 0)
+
+
+class connectionManager:
+    """ Owns the process's MongoClient. There's only ever one of these per
+    process (see 'mdb_manager' below), so a long-lived process reuses the same
+    pool of sockets for every request.
+
+    The client is created with connect=False, so importing this module doesn't
+    open any sockets. Processes that fork after using the database (e.g. the
+    pre-fork server's workers) must call after_fork() in the child: it drops
+    the sockets inherited from the parent and the child opens its own. """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.listener = None
+        client_kwargs = {
+            "maxPoolSize": settings.getint("mdb", "max_pool_size"),
+            "minPoolSize": settings.getint("mdb", "min_pool_size"),
+            "waitQueueTimeoutMS": settings.getint("mdb", "wait_queue_timeout_ms"),
+            "connect": False,
+        }
+        if PoolListenerBase is not object:
+            self.listener = poolStatsListener()
+            client_kwargs["event_listeners"] = [self.listener]
+        self.client = MongoClient(**client_kwargs)
+
+    def get_database(self, db_name):
+        return self.client[db_name]
+
+    def check_server_version(self):
+        """ Raises an exception if the mdb server is older than
+        'min_server_version'. The world stats use $convert (4.0) and plenty of
+        other code uses $lookup, $facet and $count (3.4). """
+        version = tuple(self.client.server_info()["versionArray"][:2])
+        if version < min_server_version:
+            raise Exception("MongoDB %s.%s or later is required! This server is %s.%s." % (min_server_version + version))
+        return version
+
+    def after_fork(self):
+        """ Call this in a child process right after os.fork(). """
+        if os.getpid() == self.pid:
+            return
+        self.client.close()     # the client re-opens itself on next use
+        self.pid = os.getpid()
+        if self.listener is not None:
+            self.listener.reset()
+
+    def get_stats(self):
+        """ Returns a dictionary of pool statistics for this process. """
+        stats = {
+            "pid": self.pid,
+            "max_pool_size": settings.getint("mdb", "max_pool_size"),
+        }
+        if self.listener is None:
+            return stats
+        with self.listener.lock:
+            stats.update(self.listener.stats)
+        if stats["checkouts"] > 0:
+            stats["checkout_wait_avg"] = round(stats["checkout_wait_total"] / stats["checkouts"], 4)
+        else:
+            stats["checkout_wait_avg"] = 0.0
+        return stats
+
+
+mdb_manager = connectionManager()
+mdb = mdb_manager.get_database(settings.get("application","mdb"))
 ymd = "%Y-%m-%d"
 hms = "%H:%M:%S"
 ymdhms = "%Y-%m-%d %H:%M:%S"
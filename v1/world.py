@@ -2,15 +2,26 @@
 
 from bson.objectid import ObjectId
 from datetime import datetime, timedelta
+import errno
+import fcntl
 from optparse import OptionParser
-
+import Queue
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import admin
 import assets
+import columns
 import cPickle as pickle
 import game_assets
 import html
 import os
 import session
-from utils import mdb, get_percentage, ymd, admin_session, load_settings, get_logger, thirty_days_ago, recent_session_cutoff
+from utils import mdb, mdb_manager, get_percentage, ymd, admin_session, load_settings, get_logger
 from models import Quarries, Nemeses, mutually_exclusive_principles
 
 
@@ -23,12 +34,11 @@ def multiplayer_settlements(return_type=False, threshold=1):
     """ Returns settlements with players greater than 'threshold'. """
 
     totals = {}
-    all_survivors = mdb.survivors.find()
-    for s in all_survivors:
-        if s["settlement"] not in totals.keys():
-            totals[s["settlement"]] = set([s["created_by"]])
-        else:
-            totals[s["settlement"]].add(s["created_by"])
+    results = mdb.survivors.aggregate([
+        {"$group": {"_id": "$settlement", "players": {"$addToSet": "$created_by"}}},
+    ])
+    for r in results:
+        totals[r["_id"]] = set(r["players"])
 
     multiplayer = {}
     for s in totals.keys():
@@ -186,37 +196,100 @@ def latest_fatality(return_type="html"):
     return latest_fatality
 
 
-def kill_board(return_type=None, admin=False):
-    """ Creates a dictionary showing kills by monster type. """
-    kill_list = []
-    all_settlements = mdb.settlements.find()
-    for settlement in all_settlements:
-        for m in settlement["defeated_monsters"]:
-            kill_list.append(m)
-
-    monsters = {"Other": {"sort_order": 99, "tokens": ["OTHER"], }}
+#   kills, grouped by kill string: one document per distinct string
+kill_count_pipeline = [
+    {"$unwind": "$defeated_monsters"},
+    {"$group": {"_id": "$defeated_monsters", "count": {"$sum": 1}}},
+]
+
+
+def get_kill_counts():
+    """ Returns a dict of kill strings to kill counts for all settlements. """
+
+    kill_counts = {}
+    for kill in mdb.settlements.aggregate(kill_count_pipeline):
+        if type(kill["_id"]) in [str, unicode]:
+            kill_counts[kill["_id"]] = kill["count"]
+    return kill_counts
+
+
+class killBoardIndex:
+    """ Works out which monster a user-entered kill string (e.g. "White Lion
+    Lvl 2", "Phoniex", "butcher") is a kill of. The lookups are built once,
+    from the Quarries and Nemeses models, and each distinct kill string is
+    only ever classified once. """
+
+    def __init__(self, models=[Quarries, Nemeses]):
+        self.assets = {}
+        self.tokens = {}
+        for model in models:
+            for m, asset in model.game_assets.iteritems():
+                self.assets[m] = asset
+                for token in asset["tokens"]:
+                    self.tokens.setdefault(token, []).append(m)
+
+        # longest names first, so that "Lion God" beats "Lion"
+        self.names = sorted([(m.upper(), m) for m in self.assets.keys()], key=lambda n: len(n[0]), reverse=True)
+        self.memo = {}
+
+    def classify(self, kill):
+        """ Returns the name of the monster that 'kill' is a kill of or None,
+        if we can't tell. In order of preference, a kill string is a kill of:
+
+            1.) a monster that has the whole string as a token
+            2.) the monster whose name the string starts with
+            3.) the monster with the most tokens in the string (ties go to
+                the monster with the lowest sort order)
+        """
+
+        if kill in self.memo:
+            return self.memo[kill]
+
+        monster = None
+        k_upper = kill.upper().strip()
+        if k_upper in self.tokens:
+            monster = self.tokens[k_upper][0]
+        if monster is None:
+            for name_upper, m in self.names:
+                if k_upper.startswith(name_upper):
+                    monster = m
+                    break
+        if monster is None:
+            votes = {}
+            for k_token in set(k_upper.split()):
+                for m in self.tokens.get(k_token, []):
+                    votes[m] = votes.get(m, 0) + 1
+            if votes != {}:
+                monster = sorted(votes.keys(), key=lambda m: (-votes[m], self.assets[m]["sort_order"]))[0]
+
+        self.memo[kill] = monster
+        return monster
+
+
+kill_board_index = killBoardIndex()
+
+
+def kill_board(return_type=None, admin=False, kill_counts=None):
+    """ Creates a dictionary showing kills by monster type. Pass in a dict of
+    kill strings to kill counts (e.g. the 'kills' from get_counters()) as the
+    'kill_counts' kwarg to skip the aggregation. """
+
+    if kill_counts is None:
+        kill_counts = get_kill_counts()
+
+    monsters = {"Other": {"sort_order": 99, "tokens": ["OTHER"], "kills": 0, "name": "Other"}}
     others = []
-    for model in [Quarries, Nemeses]:
-        monsters.update(model.game_assets)
-    for m in monsters:
+    for m, asset in kill_board_index.assets.iteritems():
+        monsters[m] = dict(asset)
         monsters[m]["kills"] = 0
         monsters[m]["name"] = m
 
-    for kill in kill_list:
-        categorized = False
-        k_tokenized = kill.upper().split()
-        for monster in monsters.keys():
-            if kill.upper() in monsters[monster]["tokens"]:
-                categorized = True
-                monsters[monster]["kills"] += 1
-            if not categorized:
-                for k_token in k_tokenized:
-                    if k_token in monsters[monster]["tokens"]:
-                        categorized = True
-                        monsters[monster]["kills"] += 1
-        if not categorized:
-            others.append(kill)
-            monsters["Other"]["kills"] += 1
+    for kill, count in kill_counts.iteritems():
+        monster = kill_board_index.classify(kill)
+        if monster is None:
+            others.extend([kill] * count)
+            monster = "Other"
+        monsters[monster]["kills"] += count
 
     sorted_monsters = {}
     for m in monsters:
@@ -238,13 +311,31 @@ def kill_board(return_type=None, admin=False):
 def top_principles(return_type=None):
     """ Determines which principles are most popular. """
 
+    # one aggregation: a facet per principle for its sample size, plus a count
+    #   of settlements per principle option
+    principles = sorted(mutually_exclusive_principles.keys())
+    facets = {"options": [
+        {"$unwind": "$principles"},
+        {"$group": {"_id": {"settlement": "$_id", "option": "$principles"}}},
+        {"$group": {"_id": "$_id.option", "total": {"$sum": 1}}},
+    ]}
+    for i, principle in enumerate(principles):
+        facets["sample_%s" % i] = [
+            {"$match": {"principles": {"$in": list(mutually_exclusive_principles[principle])}}},
+            {"$count": "sample_size"},
+        ]
+    results = list(mdb.settlements.aggregate([{"$facet": facets}]))[0]
+    option_totals = dict([(r["_id"], r["total"]) for r in results["options"]])
+
     popularity_contest = {}
-    for principle in mutually_exclusive_principles.keys():
+    for i, principle in enumerate(principles):
         tup = mutually_exclusive_principles[principle]
-        sample_set = mdb.settlements.find({"principles": {"$in": tup} }).count()
+        sample_set = 0
+        if results["sample_%s" % i] != []:
+            sample_set = results["sample_%s" % i][0]["sample_size"]
         popularity_contest[principle] = {"sample_size": sample_set, "options": tup}
         for option in tup:
-            total = mdb.settlements.find({"principles": {"$in": [option]}}).count()
+            total = option_totals.get(option, 0)
             popularity_contest[principle][option] = {
                 "total": total,
                 "percentage": int(get_percentage(total, sample_set)),
@@ -270,16 +361,22 @@ def popularity_contest(list_item="expansions", return_type=None):
     if list_item == "expansions":
         out_dict = {}
         for expansion in game_assets.expansions.keys():
-            out_dict[expansion] = mdb.settlements.find({"expansions": {"$in": [expansion]}}).count()
+            out_dict[expansion] = 0
+        results = mdb.settlements.aggregate([
+            {"$unwind": "$expansions"},
+            {"$group": {"_id": {"settlement": "$_id", "expansion": "$expansions"}}},
+            {"$group": {"_id": "$_id.expansion", "total": {"$sum": 1}}},
+        ])
+        for r in results:
+            if r["_id"] in out_dict.keys():
+                out_dict[r["_id"]] = r["total"]
     elif list_item == "campaigns":
-        out_dict = {"People of the Lantern": mdb.settlements.find({"campaign": {"$exists": False}}).count()}
-        campaigns = mdb.settlements.find({"campaign": {"$exists": True}}).distinct("campaign")
-        for c in campaigns:
-            total = mdb.settlements.find({"campaign": c}).count()
-            if c in out_dict.keys():
-                out_dict[c] += total
-            else:
-                out_dict[c] = total
+        out_dict = {"People of the Lantern": 0}
+        results = mdb.settlements.aggregate([
+            {"$group": {"_id": {"$ifNull": ["$campaign", "People of the Lantern"]}, "total": {"$sum": 1}}},
+        ])
+        for r in results:
+            out_dict[r["_id"]] = r["total"]
 
     output = ""
     for k in sorted(out_dict.keys()):
@@ -295,34 +392,176 @@ def popularity_contest(list_item="expansions", return_type=None):
 #   Averages and min/max queries for settlements and survivors
 #
 
+#   these are the samples that the min/max and averages are calculated from
+minmax_query = {"population": {"$gt": 4}, "death_count": {"$gt": 0}}
+average_queries = {
+    "settlements": {"$or": [{"population": {"$gt": 4}}, {"lantern_year": {"$gt": 2}}], "death_count": {"$gt": 0}},
+    "survivors": {"dead": {"$exists": False}},
+}
+
+#   (warehouse key, attrib, return_type) for the warehouse averages
+settlement_averages = [
+    ("avg_ly", "lantern_year", float),
+    ("avg_lost_settlements", "lost_settlements", int),
+    ("avg_pop", "population", int),
+    ("avg_death", "death_count", int),
+    ("avg_survival_limit", "survival_limit", float),
+    ("avg_milestones", "milestone_story_events", int),
+    ("avg_storage", "storage", float),
+    ("avg_defeated", "defeated_monsters", float),
+    ("avg_expansions", "expansions", int),
+    ("avg_innovations", "innovations", int),
+]
+survivor_averages = [
+    ("avg_disorders", "disorders", float),
+    ("avg_abilities", "abilities_and_impairments", float),
+    ("avg_hunt_xp", "hunt_xp", float),
+    ("avg_insanity", "Insanity", float),
+    ("avg_courage", "Courage", float),
+    ("avg_understanding", "Understanding", float),
+    ("avg_fighting_arts", "fighting_arts", float),
+]
+
+
+def attrib_exists(attrib):
+    """ Aggregation expression that's true if a document has 'attrib'. """
+    return {"$ne": [{"$type": "$%s" % attrib}, "missing"]}
+
+
+def attrib_as_number(attrib, return_type=int):
+    """ Aggregation expression that converts 'attrib' to a number the way
+    'return_type' would, so numeric strings (e.g. CGI form values like "3")
+    count. It's null if 'attrib' is missing or can't be converted. """
+
+    to = "double"
+    if return_type == int:
+        to = "long"     # truncates, like int()
+    return {"$convert": {"input": "$%s" % attrib, "to": to, "onError": None, "onNull": None}}
+
+
+def average_accumulators(attrib, return_type=int):
+    """ Returns a dict of $group accumulators that sum up 'attrib' (or its
+    length, if it's a list) and count the documents that have it. Use these
+    with get_average_from_sums() to finish the job. """
+
+    number = attrib_as_number(attrib, return_type)
+    is_array = {"$isArray": "$%s" % attrib}
+    return {
+        "%s_sum" % attrib: {"$sum": {"$cond": [is_array, {"$size": "$%s" % attrib}, {"$ifNull": [number, 0]}]}},
+        "%s_count" % attrib: {"$sum": {"$cond": [{"$or": [is_array, {"$ne": [number, None]}]}, 1, 0]}},
+    }
+
+
+def get_average_from_sums(sums, attrib, precision=2, return_type=int):
+    """ Turns the output of average_accumulators() into an average. """
+
+    count = sums.get("%s_count" % attrib, 0)
+    if count == 0:
+        return 0
+    total = sums["%s_sum" % attrib]
+    if return_type == int:
+        return int(total) // count
+    return round(float(total) / count, precision)
+
+
+def get_column_store(collection, attrib=None):
+    """ Returns the NumPy column snapshot (a columns.columnStore) of
+    'collection', if we've got NumPy, there's a snapshot and it has a column
+    for 'attrib'. Otherwise, returns None and you get to ask mdb. """
+
+    if columns.numpy is None:
+        return None
+    if attrib is not None and attrib not in columns.column_attribs.get(collection, []):
+        return None
+    store = columns.columnStore(collection)
+    if len(store) == 0:
+        return None
+    return store
+
+
+def refresh_columns(collection, rebuild=False):
+    """ Brings the NumPy column snapshot of 'collection' up to date. Returns
+    the number of documents that had to be read or None without NumPy. """
+    if columns.numpy is None:
+        return None
+    return columns.columnStore(collection).refresh(rebuild=rebuild)
+
+
 def get_minmax(attrib="population"):
     """ Gets the highest/lowest value for an attrib in all settlements. """
-    data_points = []
-    sample_set = mdb.settlements.find({"population": {"$gt": 4}, "death_count": {"$gt": 0}})
-    for sample in sample_set:
-        data_points.append(int(sample[attrib]))
-    return min(data_points), max(data_points)
+    store = get_column_store("settlements", attrib)
+    if store is not None:
+        return columns.get_minmax(store, attrib)
+
+    number = attrib_as_number(attrib)
+    results = list(mdb.settlements.aggregate([
+        {"$match": minmax_query},
+        {"$group": {"_id": None, "min": {"$min": number}, "max": {"$max": number}}},
+    ]))
+    if results == [] or results[0]["max"] is None:
+        return None, None
+    return int(results[0]["min"]), int(results[0]["max"])
+
+
+def get_user_asset_counts(user_ids=None):
+    """ Returns a dict of user _id to that user's settlement, survivor and
+    avatar counts, e.g. {"settlements": 2, "survivors": 40, "avatars": 3}.
+    This is one aggregation per collection, joined in memory, no matter how
+    many users there are.
+
+    Use 'user_ids' to get counts for specific users: every one of them gets a
+    dict, even if it's all zeroes. Otherwise, users who haven't created
+    anything aren't in the results. """
+
+    match = {}
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        match = {"created_by": {"$in": user_ids}}
+
+    counts = {}
+    def get_counts(user_id):
+        if user_id not in counts:
+            counts[user_id] = {"settlements": 0, "survivors": 0, "avatars": 0}
+        return counts[user_id]
+
+    if user_ids is not None:
+        for user_id in user_ids:
+            get_counts(user_id)
+
+    for r in mdb.settlements.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$created_by", "settlements": {"$sum": 1}}},
+    ]):
+        get_counts(r["_id"])["settlements"] = r["settlements"]
+
+    # gridfs queries need version 2.7+ of the gridfs pymongo driver, so we
+    #   count survivors with avatars instead of avatar files
+    for r in mdb.survivors.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": "$created_by",
+            "survivors": {"$sum": 1},
+            "avatars": {"$sum": {"$cond": [attrib_exists("avatar"), 1, 0]}},
+        }},
+    ]):
+        user_counts = get_counts(r["_id"])
+        user_counts["survivors"] = r["survivors"]
+        user_counts["avatars"] = r["avatars"]
+
+    return counts
 
 
 def user_average(return_type=False):
     """ Returns averages re: users. """
 
-    user_counts = {}
-    for user in mdb.users.find():
-        settlement_count = mdb.settlements.find({"created_by": user["_id"]}).count()
-        survivor_count = mdb.survivors.find({"created_by": user["_id"]}).count()
-#       gridfs queries need version 2.7+ of the gridfs pymongo driver
-#        avatar_count = gridfs.GridFS(mdb).find({"created_by": user["_id"]}).count()
-        avatar_count = mdb.survivors.find({"created_by": user["_id"], "avatar": {"$exists": True}}).count()
-        user_counts[user["_id"]] = {"settlements": settlement_count, "survivors": survivor_count, "avatars": avatar_count}
+    user_ids = [u["_id"] for u in mdb.users.find({}, {"_id": True})]
+    user_counts = get_user_asset_counts()
 
     averages = {"settlements": 0, "survivors": 0, "avatars": 0}
-    for asset in averages.keys():
-        data_points = []
-        for user in user_counts.keys():
-            data_points.append(user_counts[user][asset])
-        result = reduce(lambda x, y: x + y, data_points) / float(len(data_points))
-        averages[asset] = round(result,2)
+    if user_ids != []:
+        for asset in averages.keys():
+            total = sum([user_counts[u][asset] for u in user_ids if u in user_counts])
+            averages[asset] = round(total / float(len(user_ids)), 2)
 
     if return_type:
         return averages[return_type]
@@ -345,39 +584,378 @@ def get_average(collection="settlements", attrib="population", precision=2, retu
 
     """
 
-    # first, set our query based on the collection we're interrogating
-    query = {attrib: {"$exists": True}}
-    if collection == "settlements":
-        query.update({"$or": [{"population": {"$gt": 4}}, {"lantern_year": {"$gt": 2}}], "death_count": {"$gt": 0}})
-    elif collection == "survivors":
-        query.update({"dead": {"$exists": False}})
-    else:
+    if collection not in average_queries.keys():
         raise Exception("Unsupported collection type! '%s' cannot be queries!" % collection)
 
-    # now, start crunching
-    data_points = []
-    sample_set = mdb[collection].find(query)
-    for sample in sample_set:
-        try:
-            data_points.append(return_type(sample[attrib]))
-        except:
-            data_points.append(return_type(len(sample[attrib])))
-    result = reduce(lambda x, y: x + y, data_points) / len(data_points)
-    if return_type == int:
-        return result
-    elif return_type == float:
-        return round(result, precision)
+    store = get_column_store(collection, attrib)
+    if store is not None:
+        return columns.get_average(store, attrib, collection, precision, return_type)
+
+    group = {"_id": None}
+    group.update(average_accumulators(attrib, return_type))
+    results = list(mdb[collection].aggregate([{"$match": average_queries[collection]}, {"$group": group}]))
+    if results == []:
+        return 0
+    return get_average_from_sums(results[0], attrib, precision, return_type)
+
+
+def get_settlement_stats():
+    """ Scans the settlements collection once and returns a dict of warehouse
+    values: maximums and averages. The counts come from get_counters(). If
+    we've got a column snapshot, we use that instead of mdb. """
+
+    store = get_column_store("settlements")
+    if store is not None:
+        stats = {}
+        for key, attrib in [("max_pop", "population"), ("max_death", "death_count"), ("max_survival", "survival_limit")]:
+            stats[key] = columns.get_minmax(store, attrib)[1]
+        for key, attrib, return_type in settlement_averages:
+            stats[key] = columns.get_average(store, attrib, "settlements", return_type=return_type)
+        return stats
+
+    averages_group = {"_id": None}
+    for key, attrib, return_type in settlement_averages:
+        averages_group.update(average_accumulators(attrib, return_type))
+
+    minmax_group = {"_id": None}
+    for key, attrib in [("max_pop", "population"), ("max_death", "death_count"), ("max_survival", "survival_limit")]:
+        minmax_group[key] = {"$max": attrib_as_number(attrib)}
+
+    results = list(mdb.settlements.aggregate([{"$facet": {
+        "minmax": [{"$match": minmax_query}, {"$group": minmax_group}],
+        "averages": [{"$match": average_queries["settlements"]}, {"$group": averages_group}],
+    }}]))[0]
+
+    stats = {}
+    for key in ["max_pop", "max_death", "max_survival"]:
+        stats[key] = None
+        if results["minmax"] != [] and results["minmax"][0][key] is not None:
+            stats[key] = int(results["minmax"][0][key])
+    sums = {}
+    if results["averages"] != []:
+        sums = results["averages"][0]
+    for key, attrib, return_type in settlement_averages:
+        stats[key] = get_average_from_sums(sums, attrib, return_type=return_type)
+    return stats
+
+
+def get_survivor_stats():
+    """ Scans the live survivors once and returns a dict of warehouse values:
+    averages. The counts come from get_counters(). If we've got a column
+    snapshot, we use that instead of mdb. """
+
+    store = get_column_store("survivors")
+    if store is not None:
+        stats = {}
+        for key, attrib, return_type in survivor_averages:
+            stats[key] = columns.get_average(store, attrib, "survivors", return_type=return_type)
+        return stats
+
+    averages_group = {"_id": None}
+    for key, attrib, return_type in survivor_averages:
+        averages_group.update(average_accumulators(attrib, return_type))
+
+    results = list(mdb.survivors.aggregate([{"$match": average_queries["survivors"]}, {"$group": averages_group}]))
+
+    stats = {}
+    sums = {}
+    if results != []:
+        sums = results[0]
+    for key, attrib, return_type in survivor_averages:
+        stats[key] = get_average_from_sums(sums, attrib, return_type=return_type)
+    return stats
+
+
+def get_user_stats():
+    """ Scans the users collection once and returns a dict of user counts. The
+    cutoffs are computed here, rather than imported from utils, because the
+    refresher daemon runs for days. """
+
+    thirty_days_ago = datetime.now() - timedelta(days=30)
+    recent_session_cutoff = datetime.now() - timedelta(hours=12)
+    results = list(mdb.users.aggregate([{"$group": {
+        "_id": None,
+        "total_users": {"$sum": 1},
+        "total_users_last_30": {"$sum": {"$cond": [{"$gte": ["$latest_sign_in", thirty_days_ago]}, 1, 0]}},
+        "recent_sessions": {"$sum": {"$cond": [{"$gte": ["$latest_activity", recent_session_cutoff]}, 1, 0]}},
+    }}]))
+    if results == []:
+        return {"total_users": 0, "total_users_last_30": 0, "recent_sessions": 0}
+    del results[0]["_id"]
+    return results[0]
+
 
 
+#
+#   World counters: the counts on the World panel live in a single document
+#   that the application updates with $inc whenever it does something that
+#   changes one of them. reconcile_counters() rebuilds the document from
+#   scratch, to correct any drift.
+#
+
+world_counters_id = "world"
+counter_keys = ["dead_survivors", "live_survivors", "total_survivors", "active_settlements", "abandoned_settlements"]
+
+
+def escape_counter_key(s):
+    """ MongoDB field names can't contain dots or start with '$', but monster
+    names are whatever users type in, so we swap those for their full width
+    lookalikes. """
+    return s.replace(".", u"\uff0e").replace("$", u"\uff04")
+
+
+def unescape_counter_key(s):
+    return s.replace(u"\uff0e", ".").replace(u"\uff04", "$")
+
+
+def increment_counters(counters):
+    """ Atomically applies a dict of counter increments, e.g.
+    {"dead_survivors": 1, "live_survivors": -1}, to the world counters.
+
+    Failures are logged, not raised: a bad count isn't worth a failed request
+    and the next reconcile_counters() will fix it. """
+
+    if counters == {}:
+        return False
+    try:
+        mdb.world_counters.update_one({"_id": world_counters_id}, {"$inc": counters}, upsert=True)
+    except Exception as e:
+        logger = get_logger()
+        logger.exception(e)
+        logger.error("Could not update world counters: %s" % counters)
+        return False
+    return True
+
+
+def settlement_counters(settlement, increment=1):
+    """ Returns the counter increments for adding (or, with an 'increment' of
+    -1, deleting) a settlement document. Settlements created more than 30 days
+    ago aren't in 'new_settlements' anymore, so they don't touch it: nothing
+    would ever prune their date keys. """
+
+    counters = {}
+    if settlement["created_on"] >= datetime.now() - timedelta(days=30):
+        counters["new_settlements.%s" % settlement["created_on"].strftime(ymd)] = increment
+    if "removed" in settlement.keys() or "abandoned" in settlement.keys():
+        counters["abandoned_settlements"] = increment
+    else:
+        counters["active_settlements"] = increment
+    for monster_desc in settlement.get("defeated_monsters", []):
+        key = "kills.%s" % escape_counter_key(monster_desc)
+        counters[key] = counters.get(key, 0) + increment
+    return counters
+
+
+def kill_counters(monster_desc, increment=1):
+    """ Returns the counter increment for adding/removing a kill. """
+    return {"kills.%s" % escape_counter_key(monster_desc): increment}
+
+
+def reconcile_counters():
+    """ Recomputes the world counters from scratch and replaces the counters
+    document with the results. Increments that land while this is running may
+    be lost, so this is meant to be run every now and again (the warehouse
+    refresh does it), not just once. Returns the new document. """
+
+    start = datetime.now()
+    logger = get_logger()
+    thirty_days_ago = start - timedelta(days=30)
+
+    settlements = list(mdb.settlements.aggregate([{"$facet": {
+        "counts": [{"$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "abandoned": {"$sum": {"$cond": [{"$or": [attrib_exists("removed"), attrib_exists("abandoned")]}, 1, 0]}},
+        }}],
+        "new": [
+            {"$match": {"created_on": {"$gte": thirty_days_ago}}},
+            {"$group": {"_id": {"$dateToString": {"format": ymd, "date": "$created_on"}}, "count": {"$sum": 1}}},
+        ],
+        "kills": kill_count_pipeline,
+    }}]))[0]
+
+    survivors = list(mdb.survivors.aggregate([{"$group": {
+        "_id": None,
+        "total": {"$sum": 1},
+        "live": {"$sum": {"$cond": [attrib_exists("dead"), 0, 1]}},
+    }}]))
+
+    counters = {
+        "_id": world_counters_id,
+        "dead_survivors": mdb.the_dead.find().count(),
+        "live_survivors": 0,
+        "total_survivors": 0,
+        "active_settlements": 0,
+        "abandoned_settlements": 0,
+        "new_settlements": {},
+        "kills": {},
+    }
+    if survivors != []:
+        counters["live_survivors"] = survivors[0]["live"]
+        counters["total_survivors"] = survivors[0]["total"]
+    if settlements["counts"] != []:
+        counters["abandoned_settlements"] = settlements["counts"][0]["abandoned"]
+        counters["active_settlements"] = settlements["counts"][0]["total"] - counters["abandoned_settlements"]
+    for day in settlements["new"]:
+        counters["new_settlements"][day["_id"]] = day["count"]
+    for kill in settlements["kills"]:
+        if type(kill["_id"]) not in [str, unicode]:
+            continue
+        key = escape_counter_key(kill["_id"])
+        counters["kills"][key] = counters["kills"].get(key, 0) + kill["count"]
+
+    stop = datetime.now()
+    counters["reconciled_on"] = stop
+    mdb.world_counters.replace_one({"_id": world_counters_id}, counters, upsert=True)
+    logger.info("World counters reconciled in %s seconds." % (stop - start).total_seconds())
+    return counters
+
+
+def get_counters(reconcile=True):
+    """ Returns the world counters as warehouse values, plus a 'kills' dict of
+    monster name to kill count. This is one read, no matter how big the
+    database gets.
+
+    If the counters have never been reconciled, they're not worth anything:
+    we reconcile them first or, if 'reconcile' is False, return None. """
+
+    doc = mdb.world_counters.find_one({"_id": world_counters_id})
+    if doc is None or "reconciled_on" not in doc.keys():
+        if not reconcile:
+            return None
+        doc = reconcile_counters()
+
+    cutoff = (datetime.now() - timedelta(days=30)).strftime(ymd)
+    counters = {"counters_reconciled_on": doc["reconciled_on"]}
+    for k in counter_keys:
+        counters[k] = doc.get(k, 0)
+    counters["new_settlements_last_30"] = sum([v for k, v in doc.get("new_settlements", {}).iteritems() if k >= cutoff])
+    counters["kills"] = {}
+    for k, v in doc.get("kills", {}).iteritems():
+        if v > 0:
+            counters["kills"][unescape_counter_key(k)] = v
+    return counters
+
+
+#
+#   World history: every warehouse refresh appends a snapshot of its numbers
+#   to the world_history collection. Snapshots older than 'history_days' get
+#   rolled up into one snapshot per day.
+#
+
+#   the numeric warehouse values that we keep a history of
+history_keys = counter_keys + [
+    "new_settlements_last_30",
+    "max_pop", "max_death", "max_survival",
+    "total_users", "total_users_last_30", "recent_sessions",
+    "avg_user_settlements", "avg_user_survivors", "avg_user_avatars",
+] + [key for key, attrib, return_type in settlement_averages + survivor_averages]
+
+
+def append_history(data, monster_kills, created_on=None):
+    """ Appends a snapshot of the warehouse 'data' dict and the kill board
+    totals ('monster_kills' is a dict of monster name to kills) to the world
+    history. Values that aren't numbers are stored as None. """
+
+    if created_on is None:
+        created_on = datetime.now()
+
+    snapshot = {"created_on": created_on, "period": "refresh", "kills": dict(monster_kills)}
+    for k in history_keys:
+        snapshot[k] = None
+        if type(data.get(k, None)) in [int, long, float]:
+            snapshot[k] = data[k]
+    mdb.world_history.insert_one(snapshot)
+    return snapshot
+
+
+def rollup_history(history_days=30):
+    """ Replaces the per-refresh snapshots that are older than 'history_days'
+    with one snapshot per day, which has the day's average for each value and
+    the day's highest kill counts. Returns the number of days rolled up. """
+
+    cutoff = datetime.now() - timedelta(days=history_days)
+    cutoff = datetime(cutoff.year, cutoff.month, cutoff.day)     # whole days
+
+    days = {}
+    for snapshot in mdb.world_history.find({"period": "refresh", "created_on": {"$lt": cutoff}}).sort("created_on", 1):
+        days.setdefault(snapshot["created_on"].strftime(ymd), []).append(snapshot)
+
+    for day in sorted(days.keys()):
+        snapshots = days[day]
+        rollup = {"created_on": datetime.strptime(day, ymd), "period": "day", "kills": {}}
+        for k in history_keys:
+            values = [s[k] for s in snapshots if s.get(k, None) is not None]
+            rollup[k] = None
+            if values != []:
+                rollup[k] = round(sum(values) / float(len(values)), 2)
+        for s in snapshots:
+            for monster, kills in s.get("kills", {}).iteritems():
+                rollup["kills"][monster] = max(kills, rollup["kills"].get(monster, 0))
+        mdb.world_history.insert_one(rollup)
+        mdb.world_history.delete_many({"_id": {"$in": [s["_id"] for s in snapshots]}})
+
+    if days != {}:
+        get_logger().info("Rolled up %s days of world history." % len(days))
+    return len(days)
+
+
+def get_history(start, stop=None, keys=None, daily=False):
+    """ Returns the world history snapshots from 'start' to 'stop' (default:
+    now), oldest first. Use 'keys' to get only some of the values (the value
+    for "kills" is the kill board) and 'daily' to get only the last snapshot
+    of each day. """
+
+    query = {"created_on": {"$gte": start}}
+    if stop is not None:
+        query["created_on"]["$lt"] = stop
+
+    projection = None
+    if keys is not None:
+        projection = dict([(k, True) for k in keys])
+        projection.update({"_id": False, "created_on": True, "period": True})
+
+    history = list(mdb.world_history.find(query, projection).sort("created_on", 1))
+    if not daily:
+        return history
+
+    days = {}
+    for snapshot in history:
+        days[snapshot["created_on"].strftime(ymd)] = snapshot
+    return [days[d] for d in sorted(days.keys())]
+
+
+def leaderboard(collection, field, limit=5, exclude=[], query={}, unwind=False):
+    """ Returns the 'limit' most common values of 'field' in 'collection' as
+    a list of dicts, e.g. [{"name": "Zachary", "count": 12}, ...], most common
+    first. Works for any categorical field: use 'exclude' to leave values out,
+    'query' to only count some documents and 'unwind' for list fields (e.g.
+    "expansions").
+
+    Only 'field' makes it past the $match, so the $group never has to hold
+    whole documents, and big collections can spill to disk. """
+
+    match = dict(query)
+    match[field] = {"$exists": True, "$nin": exclude}
+    pipeline = [{"$match": match}, {"$project": {field: 1, "_id": 0}}]
+    if unwind:
+        pipeline.append({"$unwind": "$%s" % field})
+        if exclude != []:
+            pipeline.append({"$match": {field: {"$nin": exclude}}})
+    pipeline.extend([
+        {"$group": {"_id": "$%s" % field, "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+        {"$limit": limit},
+    ])
+    return [{field: r["_id"], "count": r["count"]} for r in mdb[collection].aggregate(pipeline, allowDiskUse=True)]
+
 
 def top_names(return_type=False, collection="survivors"):
-    """ Uses a little group querying and lambda sauce to turn out a top five
-    list of names for a collection. Don't use this against a collection that
-    doesn't have a 'name' attrib, lest ye get useless results. """
+    """ Turns out a top five list of names for a collection. Don't use this
+    against a collection that doesn't have a 'name' attrib, lest ye get
+    useless results. """
 
-    results = mdb[collection].group(["name"], {"name": {"$nin": ["Anonymous","Test","Unknown"]}}, {"count":0},"function(o, p){p.count++}")
-    sorted_list = sorted(results, key=lambda k: k["count"], reverse=True)
-    top_names = sorted_list[:5]
+    top_names = leaderboard(collection, "name", exclude=["Anonymous","Test","Unknown"])
 
     if return_type == "html":
         output = "<ol>"
@@ -389,33 +967,239 @@ def top_names(return_type=False, collection="survivors"):
     return top_names
 
 
+def run_tasks(tasks, threads=4):
+    """ Runs 'tasks', a dict of independent tasks that looks like this:
+
+        {task_name: (function, [args], {kwargs})}
+
+    on a pool of 'threads' threads and returns two dicts, keyed on task name:
+    the results and how long each task took (in seconds).
+
+    If any of the tasks raises an exception, we let the others finish and
+    then re-raise the first one. """
+
+    logger = get_logger()
+    task_queue = Queue.Queue()
+    for task_name in tasks.keys():
+        task_queue.put(task_name)
+
+    results = {}
+    timings = {}
+    failures = []
+
+    def worker():
+        while True:
+            try:
+                task_name = task_queue.get_nowait()
+            except Queue.Empty:
+                return
+            function, args, kwargs = tasks[task_name]
+            task_start = time.time()
+            try:
+                results[task_name] = function(*args, **kwargs)
+            except Exception as e:
+                logger.exception(e)
+                logger.error("Warehouse task '%s' failed!" % task_name)
+                failures.append(sys.exc_info())
+            timings[task_name] = round(time.time() - task_start, 3)
+
+    workers = []
+    for i in range(max(1, min(threads, len(tasks)))):
+        t = threading.Thread(target=worker, name="warehouse_worker_%s" % i)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
+
+    if failures != []:
+        exc_type, exc_value, exc_traceback = failures[0]
+        raise exc_type, exc_value, exc_traceback
+
+    return results, timings
+
+
+def write_atomically(path, payload):
+    """ Writes 'payload' to a temp file in the same directory as 'path' and
+    then renames it to 'path', so that readers always get either the old file
+    or the new one, never half of one. """
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".%s." % os.path.basename(path).lstrip("."))
+    out_file_handle = os.fdopen(fd, "wb")
+    try:
+        out_file_handle.write(payload)
+        out_file_handle.flush()
+        os.fsync(out_file_handle.fileno())
+        out_file_handle.close()
+        os.rename(temp_path, path)
+    except:
+        out_file_handle.close()
+        os.remove(temp_path)
+        raise
+
+
 class WarehouseObject:
     """ Initialize one of these to get the latest World data object. This is
     your one-stop-shop for all Dashboard -> World type data and all requests
     for this info should go through this guy: running the other methods in this
     module as one-offs is officially deprecated. """
 
-    def __init__(self, refresh=False):
+    def __init__(self, refresh=False, background=False, passive=False):
+        """ Normally, this reads the warehouse pickle and, if the pickle is
+        stale, starts a refresh in a separate process and carries on with the
+        stale data. Nobody waits for a refresh unless there's no pickle at all.
+
+        Use the 'refresh' kwarg to force a refresh (and wait for it). The
+        'background' kwarg is for the refresh process: it refreshes unless
+        somebody else already is.
+
+        A 'passive' warehouse only reads: it never starts a refresh, even if
+        there's no pickle. If the 'warehouse_daemon' setting is True, because
+        the refresher daemon (world.py -D) keeps the pickle fresh, warehouses
+        are passive unless you ask for a refresh. """
+
         self.logger = get_logger()
         self.settings = load_settings()
         self.meta = {}
+        self.data = {}
+        self.html_data = {}
+        self.timings = {}
+        self.status = {}
         self.meta["pickle_age_threshold"] = self.settings.getint("application","warehouse_age")
         self.meta["pickle_path"] = os.path.abspath(self.settings.get("application","warehouse_file"))
+        self.meta["lock_path"] = self.meta["pickle_path"] + ".lock"
+        self.meta["counters_reconcile_age"] = self.settings.getint("application","counters_reconcile_age")
+        self.meta["history_days"] = self.settings.getint("application","history_days")
+        self.meta["warehouse_threads"] = self.settings.getint("application","warehouse_threads")
+        self.meta["status_path"] = self.meta["pickle_path"] + ".status"
+        self.meta["passive"] = passive
+        if self.settings.getboolean("application","warehouse_daemon") and not refresh and not background:
+            self.meta["passive"] = True
 
         if refresh:
-            self.refresh()
-            self.write_pickle()
+            self.refresh_and_publish(blocking=True, force=True)
+        elif background:
+            self.refresh_and_publish(blocking=False)
 
-        if not os.path.isfile(self.meta["pickle_path"]):
-            self.refresh()
-            self.write_pickle()
-        else:
+        if not os.path.isfile(self.meta["pickle_path"]) and not self.meta["passive"]:
+            self.refresh_and_publish(blocking=True)
+
+        for k, v in self.read_status().iteritems():
+            self.meta["refresh_%s" % k] = v
+
+        if os.path.isfile(self.meta["pickle_path"]):
             self.read_pickle()
-            pickle_age = (datetime.now() - self.meta["pickle_created_on"]).seconds % 3600 // 60
-            if pickle_age > self.meta["pickle_age_threshold"]:
+            pickle_age = self.get_pickle_age()
+            if pickle_age > self.meta["pickle_age_threshold"] and not background and not self.meta["passive"]:
                 self.logger.debug("Pickle is %s minutes old (threshold is %s minutes)." % (pickle_age, self.meta["pickle_age_threshold"]))
-                self.refresh()
+                self.refresh_in_background()
+            self.read_counters()
+
+
+    def get_pickle_age(self):
+        """ Returns the age of the pickle in (whole) minutes. """
+        return int((datetime.now() - self.meta["pickle_created_on"]).total_seconds() // 60)
+
+
+    def refresh_in_background(self):
+        """ Starts 'world.py -B' in its own process to refresh the warehouse,
+        unless a refresh is already running. Returns immediately.
+
+        The refresh is double-forked: we only wait for the (short-lived)
+        intermediate process, and the refresh itself gets re-parented to init,
+        which reaps it. Long-lived servers don't collect zombies that way. """
+
+        if self.refresh_is_running():
+            return False
+
+        world_path = os.path.abspath(__file__).replace(".pyc", ".py")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.setsid()
+                devnull = open(os.devnull, "r+")
+                subprocess.Popen(
+                    [sys.executable, world_path, "-B"],
+                    cwd=os.path.dirname(world_path),
+                    stdin=devnull, stdout=devnull, stderr=devnull,
+                    close_fds=True,
+                )
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.logger.debug("Started background warehouse refresh.")
+        return True
+
+
+    def refresh_is_running(self):
+        """ Returns True if somebody is holding the refresh lock. """
+
+        lock_handle = open(self.meta["lock_path"], "a")
+        try:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+            return True
+        finally:
+            lock_handle.close()     # this releases the lock, if we got it
+        return False
+
+
+    def refresh_and_publish(self, blocking=True, force=False):
+        """ Refreshes the warehouse and writes a new pickle while holding the
+        refresh lock, so that only one process at a time does it. If 'blocking'
+        is False and somebody else already has the lock, we don't bother.
+        Unless 'force' is True, we also don't bother if somebody else wrote a
+        fresh pickle while we were waiting for the lock.
+
+        Returns True if we wrote a new pickle. """
+
+        lock_handle = open(self.meta["lock_path"], "a")
+        try:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags = flags | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_handle, flags)
+            except IOError as e:
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    raise
+                self.logger.debug("Warehouse refresh already in progress.")
+                return False
+
+            if not force and os.path.isfile(self.meta["pickle_path"]):
+                pickle_age = (time.time() - os.path.getmtime(self.meta["pickle_path"])) // 60
+                if pickle_age <= self.meta["pickle_age_threshold"]:
+                    return False
+
+            refresh_start = datetime.now()
+            if self.refresh():
                 self.write_pickle()
+                self.write_history()
+                self.write_status(refresh_start, succeeded=True)
+                return True
+            self.write_status(refresh_start, succeeded=False)
+            return False
+        finally:
+            lock_handle.close()
+
+
+    def read_counters(self):
+        """ Overwrites the counts from the pickle with the current values of
+        the world counters, which costs us one find_one(). If the counters
+        haven't been reconciled yet, we stick with the pickle. """
+        try:
+            counters = get_counters(reconcile=False)
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.error("Unable to read world counters!")
+            return False
+        if counters is None:
+            return False
+        del counters["kills"]
+        self.data.update(counters)
+        return True
 
 
     def dump(self):
@@ -439,12 +1223,17 @@ class WarehouseObject:
 
 
     def refresh(self):
-        """ Basically wraps the get_data() method in a try/except. """
+        """ Basically wraps the get_data() method in a try/except. Returns True
+        if the refresh worked. """
+        self.refresh_error = None
         try:
             self.get_data()
         except Exception as e:
             self.logger.exception(e)
             self.logger.error("Unable to refresh data warehouse!")
+            self.refresh_error = "%s: %s" % (type(e).__name__, e)
+            return False
+        return True
 
 
     def get_data(self):
@@ -456,78 +1245,136 @@ class WarehouseObject:
         self.data = {}
         self.html_data = {}
 
-        # do organic/one-off/manual queries first
-        self.data["dead_survivors"] = mdb.the_dead.find().count()
-        self.data["live_survivors"] = mdb.survivors.find({"dead": {"$exists": False}}).count()
-        self.data["total_survivors"] = mdb.survivors.find().count()
-        self.data["abandoned_settlements"] = mdb.settlements.find({"$or": [{"removed": {"$exists": True}}, {"abandoned": {"$exists": True}}]}).count()
-        self.data["active_settlements"] = mdb.settlements.find().count() - self.data["abandoned_settlements"]
-        self.data["total_users"] = mdb.users.find().count()
-        self.data["total_users_last_30"] = mdb.users.find({"latest_sign_in": {"$gte": thirty_days_ago}}).count()
-        self.data["new_settlements_last_30"] = mdb.settlements.find({"created_on": {"$gte": thirty_days_ago}}).count()
-        self.data["recent_sessions"] = mdb.users.find({"latest_activity": {"$gte": recent_session_cutoff}}).count()
-
-        # canned and special world modules next
-        self.html_data["total_multiplayer"] = multiplayer_settlements("total_settlements")
-        self.html_data["defeated_monsters"] = kill_board("html_table_rows")
-        self.html_data["latest_kill"] = latest_kill("html")
-        self.html_data["top_principles"] = top_principles("html_ul")
-        self.html_data["expansion_popularity_bullets"] = popularity_contest("expansions")
-        self.html_data["campaign_popularity_bullets"] = popularity_contest("campaigns")
-        self.html_data["latest_fatality"] = latest_fatality()
-        self.html_data["current_hunt"] = current_hunt()
-        self.html_data["latest_survivor"] = latest_survivor()
-        self.html_data["latest_settlement"] = latest_settlement()
-        self.html_data["top_survivor_names"] = top_names("html")
-        self.html_data["top_settlement_names"] = top_names("html", collection="settlements")
-
-        # min/max queries
-        self.data["max_pop"] = get_minmax("population")[1]
-        self.data["max_death"] = get_minmax("death_count")[1]
-        self.data["max_survival"] = get_minmax("survival_limit")[1]
-
-        # settlement averages
-        self.data["avg_ly"] = get_average(attrib="lantern_year", return_type=float)
-        self.data["avg_lost_settlements"] = get_average(attrib="lost_settlements")
-        self.data["avg_pop"] = get_average(attrib="population")
-        self.data["avg_death"] = get_average(attrib="death_count")
-        self.data["avg_survival_limit"] = get_average(attrib="survival_limit", return_type=float)
-        self.data["avg_milestones"] = get_average(attrib="milestone_story_events")
-        self.data["avg_storage"] = get_average(attrib="storage", return_type=float)
-        self.data["avg_defeated"] = get_average(attrib="defeated_monsters", return_type=float)
-        self.data["avg_expansions"] = get_average(attrib="expansions")
-        self.data["avg_innovations"] = get_average(attrib="innovations")
-
-        # survivor averages
-        self.data["avg_disorders"] = get_average(collection="survivors", attrib="disorders", return_type=float)
-        self.data["avg_abilities"] = get_average(collection="survivors", attrib="abilities_and_impairments", return_type=float)
-        self.data["avg_hunt_xp"] = get_average(collection="survivors", attrib="hunt_xp", return_type=float)
-        self.data["avg_insanity"] = get_average(collection="survivors", attrib="Insanity", return_type=float)
-        self.data["avg_courage"] = get_average(collection="survivors", attrib="Courage", return_type=float)
-        self.data["avg_understanding"] = get_average(collection="survivors", attrib="Understanding", return_type=float)
-        self.data["avg_fighting_arts"] = get_average(collection="survivors", attrib="fighting_arts", return_type=float)
+        # counts come from the world counters, which get reconciled every
+        #   'counters_reconcile_age' minutes to correct any drift
+        counters = get_counters()
+        counters_age = (datetime.now() - counters["counters_reconciled_on"]).total_seconds() // 60
+        if counters_age > self.meta["counters_reconcile_age"]:
+            reconcile_counters()
+            counters = get_counters()
+        kill_counts = counters.pop("kills")
+        self.data.update(counters)
+
+        # bring the NumPy column snapshots up to date (if we've got NumPy),
+        #   since the stats tasks read them
+        column_tasks = {
+            "settlement_columns": (refresh_columns, ["settlements"], {}),
+            "survivor_columns": (refresh_columns, ["survivors"], {}),
+        }
+        column_results, column_timings = run_tasks(column_tasks, self.meta["warehouse_threads"])
+
+        # everything else is independent of everything else, so it all runs
+        #   at the same time on the warehouse thread pool
+        tasks = {
+            "settlement_stats": (get_settlement_stats, [], {}),
+            "survivor_stats": (get_survivor_stats, [], {}),
+            "user_stats": (get_user_stats, [], {}),
+            "user_average": (user_average, [], {}),
+            "total_multiplayer": (multiplayer_settlements, ["total_settlements"], {}),
+            "defeated_monsters": (kill_board, ["html_table_rows"], {"kill_counts": kill_counts}),
+            "latest_kill": (latest_kill, ["html"], {}),
+            "top_principles": (top_principles, ["html_ul"], {}),
+            "expansion_popularity_bullets": (popularity_contest, ["expansions"], {}),
+            "campaign_popularity_bullets": (popularity_contest, ["campaigns"], {}),
+            "latest_fatality": (latest_fatality, [], {}),
+            "current_hunt": (current_hunt, [], {}),
+            "latest_survivor": (latest_survivor, [], {}),
+            "latest_settlement": (latest_settlement, [], {}),
+            "top_survivor_names": (top_names, ["html"], {}),
+            "top_settlement_names": (top_names, ["html"], {"collection": "settlements"}),
+        }
+        results, timings = run_tasks(tasks, self.meta["warehouse_threads"])
+        timings.update(column_timings)
+        self.timings = timings
+
+        # min/max and averages: one aggregation per collection
+        for task in ["settlement_stats", "survivor_stats", "user_stats"]:
+            self.data.update(results.pop(task))
 
         # user averages
-        ua = user_average()
+        ua = results.pop("user_average")
         self.data["avg_user_settlements"] = ua["settlements"]
         self.data["avg_user_survivors"] = ua["survivors"]
         self.data["avg_user_avatars"] = ua["avatars"]
 
+        # canned and special world modules
+        self.html_data.update(results)
+        self.monster_kills = dict([(m["name"], m["kills"]) for m in kill_board(kill_counts=kill_counts).values()])
+
         stop = datetime.now()
+        self.timings["total"] = round((stop-start).total_seconds(), 3)
         self.logger.debug("Warehouse refreshed in %s seconds. %s data keys; %s HTML keys." % (((stop-start).total_seconds()), len(self.data.keys()), len(self.html_data.keys())))
+        slowest = sorted([t for t in timings.keys()], key=lambda t: timings[t], reverse=True)[:3]
+        self.logger.debug("Slowest warehouse tasks: %s" % ", ".join(["%s (%ss)" % (t, timings[t]) for t in slowest]))
 
 
     def write_pickle(self):
-        """ Writes a brand new pickle warehouse. """
-        out_file_handle = file(self.meta["pickle_path"], "wb")
-        out_file_handle.write(pickle.dumps({"created_on": datetime.now(), "html_data": self.html_data, "data": self.data}))
-        out_file_handle.close()
+        """ Writes a brand new pickle warehouse. The pickle is written to a temp
+        file first and then renamed into place, so readers always get either
+        the old pickle or the new one, never half of one. """
+        write_atomically(self.meta["pickle_path"], pickle.dumps({"created_on": datetime.now(), "html_data": self.html_data, "data": self.data, "timings": self.timings}))
         if os.path.isfile(self.meta["pickle_path"]):
             self.logger.info("Warehouse pickle written to '%s'." % self.meta["pickle_path"])
         else:
             raise Exception("Could not write warehouse pickle!")
 
 
+    def write_history(self):
+        """ Appends the freshly refreshed data to the world history and rolls
+        up the old history. A failure here is logged, but it doesn't fail
+        the refresh. """
+        try:
+            append_history(self.data, self.monster_kills)
+            rollup_history(self.meta["history_days"])
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.error("Unable to update world history!")
+            return False
+        return True
+
+
+    def read_status(self):
+        """ Returns the refresh status dict (see write_status()) or an empty
+        dict, if nobody has refreshed yet. """
+        if not os.path.isfile(self.meta["status_path"]):
+            return {}
+        try:
+            in_file_handle = file(self.meta["status_path"], "rb")
+            status = pickle.loads(in_file_handle.read())
+            in_file_handle.close()
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.error("Unable to read warehouse refresh status!")
+            return {}
+        return status
+
+
+    def write_status(self, refresh_start, succeeded=True):
+        """ Records how the refresh that started at 'refresh_start' went, next
+        to the pickle: duration, last success/failure and the number of
+        failures in a row. """
+
+        status = self.read_status()
+        now = datetime.now()
+        status["last_attempt"] = refresh_start
+        status["last_duration"] = round((now - refresh_start).total_seconds(), 3)
+        if succeeded:
+            status["last_success"] = now
+            status["consecutive_failures"] = 0
+        else:
+            status["last_failure"] = now
+            status["last_error"] = self.refresh_error
+            status["consecutive_failures"] = status.get("consecutive_failures", 0) + 1
+            status["total_failures"] = status.get("total_failures", 0) + 1
+        self.status = status
+
+        try:
+            write_atomically(self.meta["status_path"], pickle.dumps(status))
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.error("Unable to write warehouse refresh status!")
+
+
     def read_pickle(self):
         """ Reads the pickle from the file system: resurrects data and
         html_data into the object. """
@@ -538,6 +1385,9 @@ class WarehouseObject:
         self.meta["pickle_created_on"] = p["created_on"]
         self.data = p["data"]
         self.html_data = p["html_data"]
+        self.timings = p.get("timings", {})
+        for task, seconds in self.timings.iteritems():
+            self.meta["seconds_%s" % task] = seconds
 #        self.logger.debug("Pickle loaded successfully. Warehouse object refreshed.")
 
 
@@ -568,21 +1418,106 @@ class WarehouseObject:
 
 
 
+#
+#   The refresher daemon: world.py -D
+#
+
+def mongo_is_busy(max_queue):
+    """ Returns True if more than 'max_queue' operations are waiting on locks
+    on the mdb server. If we can't get its serverStatus (e.g. we don't have the
+    privileges), we assume that it isn't busy. """
+    try:
+        server_status = mdb.command("serverStatus")
+    except Exception as e:
+        return False
+    return server_status.get("globalLock", {}).get("currentQueue", {}).get("total", 0) > max_queue
+
+
+def run_refresher():
+    """ Refreshes and publishes the warehouse every 'refresher_interval'
+    seconds until it gets a SIGTERM or SIGINT. Set 'warehouse_daemon' to True
+    in settings.cfg when this is running, so that requests only ever read the
+    pickle. While we're at it, we run the session sweeper (see
+    admin.prune_sessions()).
+
+    When a refresh fails or mdb is busy, we back off: the wait doubles every
+    time, up to 'refresher_max_backoff' seconds, and goes back to normal after
+    the next refresh that works. """
+
+    settings = load_settings()
+    logger = get_logger()
+    interval = settings.getint("application","refresher_interval")
+    max_backoff = settings.getint("application","refresher_max_backoff")
+    max_queue = settings.getint("application","refresher_max_queue")
+
+    stop_signals = []
+    def request_stop(signum, frame):
+        stop_signals.append(signum)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    mdb_manager.check_server_version()
+    W = WarehouseObject(passive=True)
+    backoff = 0
+    logger.info("Warehouse refresher started (interval: %s seconds)." % interval)
+    while stop_signals == []:
+        last_attempt = W.status.get("last_attempt", None)
+        if mongo_is_busy(max_queue):
+            backoff += 1
+            logger.warn("mdb is busy: skipping warehouse refresh.")
+        elif W.refresh_and_publish(blocking=False, force=True):
+            backoff = 0
+            logger.info("Warehouse refreshed in %s seconds." % W.status["last_duration"])
+        elif W.status.get("last_attempt", None) != last_attempt:
+            backoff += 1
+            logger.error("Warehouse refresh failed (%s failures in a row): %s" % (W.status["consecutive_failures"], W.status["last_error"]))
+        else:
+            logger.debug("Somebody else is refreshing the warehouse.")
+
+        if backoff == 0:
+            try:
+                admin.prune_sessions()
+            except Exception as e:
+                logger.error("Session sweeper failed!")
+                logger.exception(e)
+
+        wait = min(max_backoff, interval * 2 ** backoff)
+        if backoff > 0:
+            logger.warn("Backing off: next warehouse refresh in %s seconds." % wait)
+        next_refresh = time.time() + wait
+        while stop_signals == [] and time.time() < next_refresh:
+            time.sleep(1)
+
+    logger.info("Warehouse refresher stopped.")
+
+
 if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-u", dest="user_avg", help="Returns averages re: users. Try: 'survivors', 'settlements', 'avatars'", metavar="survivors", default=False)
     parser.add_option("-a", dest="average", help="Returns an average for the specified value", metavar="population", default=False)
     parser.add_option("-t", dest="top", help="Returns top five names for survivors/settlements.", metavar="survivors", default=False)
+    parser.add_option("-P", dest="percentiles", help="Returns percentiles and a histogram for the specified value (requires NumPy)", metavar="hunt_xp", default=False)
     parser.add_option("-m", dest="minmax", help="Returns min/max numbers the specified value", metavar="death_count", default=False)
     parser.add_option("-M", dest="multiplayer", help="Dump the multiplayer settlement count.", default=False, action="store_true")
     parser.add_option("-k", dest="kill_board", help="Run the kill_board func and print its contents.", default=False, action="store_true")
     parser.add_option("-p", dest="top_principles", help="Run the top_principles func and print its contents.", default=False, action="store_true")
     parser.add_option("-W", dest="warehouse", help="Dump the warehouse repr.", default=False, action="store_true")
     parser.add_option("-R", dest="warehouse_refresh", help="Force the warehouse to refresh", default=False, action="store_true")
+    parser.add_option("-B", dest="warehouse_background", help="Refresh the warehouse, unless a refresh is already running", default=False, action="store_true")
+    parser.add_option("-H", dest="history", help="Dump the daily world history of the specified value", metavar="avg_ly", default=False)
+    parser.add_option("-d", dest="days", help="Number of days of history to dump (use with -H)", metavar="30", type="int", default=30)
+    parser.add_option("-D", dest="refresher", help="Run the warehouse refresher daemon in the foreground", default=False, action="store_true")
+    parser.add_option("-C", dest="reconcile_counters", help="Recompute the world counters from scratch", default=False, action="store_true")
     (options, args) = parser.parse_args()
 
     start = datetime.now()
 
+    if options.reconcile_counters:
+        reconcile_counters()
+        print get_counters()
+    if options.history:
+        for snapshot in get_history(datetime.now() - timedelta(days=options.days), keys=[options.history], daily=True):
+            print("%s\t%s" % (snapshot["created_on"].strftime(ymd), snapshot.get(options.history, None)))
     if options.top:
         print top_names(options.top)
     if options.user_avg:
@@ -597,12 +1532,23 @@ if __name__ == "__main__":
         print get_average(options.average)
     if options.minmax:
         print get_minmax(options.minmax)
+    if options.percentiles:
+        for collection in ["settlements", "survivors"]:
+            store = get_column_store(collection, options.percentiles)
+            if store is not None:
+                print columns.get_percentiles(store, options.percentiles, sample=collection)
+                for bin_start, bin_end, count in columns.get_histogram(store, options.percentiles, sample=collection):
+                    print("%8.2f - %8.2f\t%s" % (bin_start, bin_end, count))
     if options.warehouse:
         W = WarehouseObject(refresh=options.warehouse_refresh)
         for d in W.dump():
             print d
     if not options.warehouse and options.warehouse_refresh:
         W = WarehouseObject(refresh=True)
+    if options.warehouse_background:
+        W = WarehouseObject(background=True)
+    if options.refresher:
+        run_refresher()
 
     stop = datetime.now()
     duration = stop - start